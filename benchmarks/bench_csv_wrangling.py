@@ -0,0 +1,153 @@
+"""
+Benchmark of the Zählstelle csv parsers in csv-wrangling.py on synthetic multi-year exports.
+
+Compares the original line-by-line "read_zählstellen" with the chunked, vectorised
+"read_zählstellen_chunked": wall time, peak python memory, size of the resulting
+dataframe and equality of the results. Also checks that both parsers give the same rows
+and the same ParseReport for a file of malformed tables, with blocks of any size.
+
+    > python benchmarks/bench_csv_wrangling.py --years 3 --stations 16
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from common import measure
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEEKDAYS = ['Montag', 'Dienstag', 'Mittwoch', 'Donnerstag', 'Freitag', 'Samstag', 'Sonntag']
+
+
+def load_wrangling():
+    ### csv-wrangling.py is not importable by name because of the hyphen
+    spec = importlib.util.spec_from_file_location('csv_wrangling', os.path.join(ROOT, 'csv-wrangling.py'))
+    module = importlib.util.module_from_spec(spec)
+    ### Registered, so the process pool can pickle its functions by reference
+    sys.modules['csv_wrangling'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_export(filename, year, stations, seed=0):
+    """
+    Writes one synthetic yearly export: a 24 hour table per station and day, separated by
+    irregular text. Even years use the "1.1" date layout, odd years the "1,1" layout.
+    """
+    rng = np.random.default_rng(seed + year)
+    days = pd.date_range(f'{year}-01-01', f'{year}-12-31', freq='D')
+    with open(filename, 'w', newline='') as f:
+        for station in stations:
+            for day in days:
+                if year % 2 == 0:
+                    date = f'" {day.day}.{day.month}","{year}"'
+                else:
+                    date = f'" {day.day}"," {day.month}","{year}"'
+                f.write(f'"Zählstelle {station} Teststraße","{WEEKDAYS[day.weekday()]}",{date}\n')
+                f.write('"Uhrzeit","PKW","LKW","Gesamt"\n')
+                pkw = rng.integers(50, 3000, 24)
+                lkw = rng.integers(0, 300, 24)
+                for hour in range(1, 25):
+                    time_ = '24:00:00' if hour == 24 else f'{hour}:00'
+                    f.write(f'"{time_}","{pkw[hour-1]}","{lkw[hour-1]}","{pkw[hour-1] + lkw[hour-1]}"\n')
+                f.write('\n"Summe",,,\n\n')
+
+
+def write_malformed(filename):
+    """
+    Writes an export with the kinds of broken lines the parsers must agree on. Returns the
+    expected ParseReport counts.
+    """
+    def table(heading, hours=range(1, 25), row='"{time_}","10","2","12"'):
+        lines = [heading, '"Uhrzeit","PKW","LKW","Gesamt"']
+        lines += [row.format(time_='24:00:00' if hour == 24 else f'{hour}:00') for hour in hours]
+        return lines + ['', '"Summe",,,', '']
+
+    lines = ['"3:00","1","2","3"']                                             # row before any table
+    lines += table('"Zählstelle 1013 Teststraße","Montag"," 1.1","2012"')
+    lines += table('"Zählstelle 1013 Teststraße","Dienstag"," 2"," 1","2012"',
+                   row='"{time_}","10","2","12",')                             # trailing comma
+    lines += table('"Zählstelle 1013 Teststraße","Mittwoch"," 3.1","2012"', hours=range(1, 23),
+                   row='"{time_}","10","","12"')                               # blank counts, 22 rows
+    lines += ['"25:00","1","1","2"', '"7:00","1"', '"12:30","1","1","2"',      # malformed rows
+              '"7:00","-1","1","2"', '"7:00","1","1","2","3"', '2012 Summe,,,']
+    lines += table('"Zählstelle abc Teststraße","Donnerstag"," 4.1","2012"')  # malformed headings
+    lines += table('"Zählstelle 1013 Teststraße","Freitag"," 32.1","2012"')
+    lines += table('"Zählstelle 1014 Teststraße","Samstag"," 7.1","2012"')
+    with open(filename, 'w', newline='') as f:
+        f.write('\r\n'.join(lines))
+    return {'tables': 4, 'rows': 24 * 3 + 22, 'malformed_headers': 2, 'malformed_rows': 6,
+            'rows_outside_tables': 1 + 2 * 24, 'blank_counts': 22, 'hour24': 3,
+            'incomplete': [(1013, '2012-01-03', 22)]}
+
+
+def check_malformed(wrangling, filename):
+    """Both parsers, the chunked one with blocks from a few lines to the whole file, give the
+    same rows and the expected report."""
+    expected = write_malformed(filename)
+    results = []
+    for func, kwargs in [(wrangling.read_zählstellen, {}),
+                         (wrangling.read_zählstellen_chunked, {'chunksize': 64}),
+                         (wrangling.read_zählstellen_chunked, {'chunksize': 1000}),
+                         (wrangling.read_zählstellen_chunked, {})]:
+        report = wrangling.ParseReport()
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = func(filename, report=report, **kwargs)
+        found = {key: getattr(report, key) for key in expected}
+        assert found == expected, f'{func.__name__} {kwargs}: {found} != {expected}'
+        results.append(df.apply(pd.to_numeric, errors='coerce').astype('Int64'))
+    for df in results[1:]:
+        pd.testing.assert_frame_equal(results[0], df, check_freq=False)
+    print('Malformed tables: same rows and report from both parsers')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=3, help='number of yearly files, starting 2012')
+    parser.add_argument('--stations', type=int, default=16, help='number of stations per file')
+    args = parser.parse_args()
+
+    wrangling = load_wrangling()
+    stations = [1013 + i for i in range(args.stations)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for year in range(2012, 2012 + args.years):
+            filename = os.path.join(tmp, f'Anfrage_SWiesner_{year}.csv')
+            write_export(filename, year, stations)
+            files.append(filename)
+        size = sum(os.path.getsize(f) for f in files) / 1e6
+        print(f'{len(files)} files, {len(stations)} stations, {size:.1f} MB')
+
+        results = {}
+        for name, func in [('read_zählstellen', wrangling.read_zählstellen),
+                           ('read_zählstellen_chunked', wrangling.read_zählstellen_chunked)]:
+            total, peak, frames = 0.0, 0, []
+            for filename in files:
+                df, elapsed, mem = measure(func, filename)
+                total += elapsed
+                peak = max(peak, mem)
+                frames.append(df)
+            results[name] = pd.concat(frames)
+            size = results[name].memory_usage(deep=True).sum()
+            print(f'{name:>26}: {total:7.2f} s, peak memory {peak / 1e6:7.1f} MB, '
+                  f'result {size / 1e6:7.1f} MB')
+
+    ### The original returns strings, compare on integer values
+    old = results['read_zählstellen'].astype('int64')
+    new = results['read_zählstellen_chunked'].astype('int64')
+    pd.testing.assert_frame_equal(old, new, check_freq=False)
+    print('Results are identical')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        check_malformed(wrangling, os.path.join(tmp, 'malformed.csv'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark of the daily aggregation of the hourly Zählstelle data on a synthetic dataset.
+
+Compares the per-station "daily_sum_station" followed by "InterpolateImputer" (as in
+notebook 06) with the one-pass "daily_sums" of notebooks/trafficForecast.py: wall time,
+peak python memory and equality of the results.
+
+    > python benchmarks/bench_daily_sums.py --years 11 --stations 16
+"""
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'notebooks'))
+
+import trafficForecast as tf
+import trafficModules as tm
+from common import make_hourly, measure
+
+
+def per_station(df, stations):
+    imputer = tm.InterpolateImputer()
+    return {zähl: imputer.transform(tf.daily_sum_station(df, zähl)) for zähl in stations}
+
+
+def one_pass(df, stations):
+    df_y, df_missing = tf.daily_sums(df, stations, interpolate=True)
+    return {zähl: tf.daily_frame(df_y, df_missing, zähl) for zähl in stations}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=11, help='number of years, starting 2012')
+    parser.add_argument('--stations', type=int, default=16, help='number of stations')
+    args = parser.parse_args()
+
+    stations = [1013 + i for i in range(args.stations)]
+    df = make_hourly(args.years, stations)
+    print(f'{len(df)} hourly rows, {len(stations)} stations, {df.memory_usage(deep=True).sum() / 1e6:.1f} MB')
+
+    results = {}
+    for name, func in [('daily_sum_station', per_station), ('daily_sums', one_pass)]:
+        results[name], elapsed, peak = measure(func, df, stations)
+        print(f'{name:>18}: {elapsed:7.3f} s, peak memory {peak / 1e6:7.1f} MB')
+
+    for zähl in stations:
+        pd.testing.assert_frame_equal(results['daily_sum_station'][zähl], results['daily_sums'][zähl],
+                                      check_dtype=False, check_freq=False)
+    print('Results are identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Load and latency benchmark of the dashboard callbacks in dashboard/app.py.
+
+Calls "update_from_dropdown" for every (station, day) with predictions and
+"set_dropdown_from_map" for every station, both directly and as HTTP requests through
+the Flask test client of app.server, from 1, 4 and 16 concurrent clients. Reports
+p50/p95/p99 latency and throughput, with the figure cache cold (disabled) and warm.
+Runs offline: the weather forecast is stubbed and a dummy Mapbox key is used.
+
+    > python benchmarks/bench_dashboard.py --clients 1 4 16 --max-p95-ms 50
+
+With --max-p95-ms the script exits with 1 if any p95 is above the limit, e.g. to
+check for a regression before deploying.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DASHBOARD = os.path.join(ROOT, 'dashboard')
+
+DROPDOWN_OUTPUTS = [('timeseries', 'figure'), ('map', 'figure'), ('time-title', 'children'),
+                    ('indicator', 'figure'), ('indic-text', 'children')]
+
+
+def load_app():
+    ### app.py reads its data files relative to the working directory
+    os.environ.setdefault('WEATHER_STUB', '1')
+    os.environ.setdefault('MAP_BOX_KEY', 'offline-benchmark')
+    os.chdir(DASHBOARD)
+    sys.path.insert(0, DASHBOARD)
+    import app
+    return app
+
+
+def dropdown_payload(stelle, day):
+    """Body of the request the browser sends when a station and day are selected."""
+    return {'output': '..' + '...'.join(f'{id_}.{prop}' for id_, prop in DROPDOWN_OUTPUTS) + '..',
+            'outputs': [{'id': id_, 'property': prop} for id_, prop in DROPDOWN_OUTPUTS],
+            'inputs': [{'id': 'dropdown-menu', 'property': 'value', 'value': stelle},
+                       {'id': 'date-picker', 'property': 'date', 'value': day}],
+            'changedPropIds': ['dropdown-menu.value']}
+
+
+def map_payload(alias):
+    """Body of the request the browser sends when a station is clicked on the map."""
+    return {'output': 'dropdown-menu.value',
+            'outputs': {'id': 'dropdown-menu', 'property': 'value'},
+            'inputs': [{'id': 'map', 'property': 'clickData', 'value': {'points': [{'text': alias}]}},
+                       {'id': 'map-parent', 'property': 'n_clicks', 'value': 1}],
+            'changedPropIds': ['map.clickData']}
+
+
+def run(calls, clients):
+    """
+    Runs every call once, spread over `clients` threads. Returns the latency of every
+    call in seconds and the wall time of the whole run.
+    """
+    local = threading.local()
+
+    def timed(call):
+        start = time.perf_counter()
+        call(local)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if clients == 1:
+        latencies = [timed(call) for call in calls]
+    else:
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            latencies = list(pool.map(timed, calls))
+    return np.array(latencies), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16], help='concurrent client counts')
+    parser.add_argument('--repeat', type=int, default=1, help='passes over all stations and days per run')
+    parser.add_argument('--max-p95-ms', type=float, help='fail if any p95 latency is above this')
+    args = parser.parse_args()
+
+    app = load_app()
+    keys = sorted(app.pred_store.keys())
+    aliases = list(app.locations.alias)
+    print(f'{len(keys)} station/day pairs, {len(aliases)} stations')
+
+    def direct_dropdown(stelle, day):
+        def call(local):
+            app.update_from_dropdown(stelle, day)
+        return call
+
+    def direct_map(alias):
+        def call(local):
+            app.set_dropdown_from_map({'points': [{'text': alias}]}, 1)
+        return call
+
+    def http(payload):
+        def call(local):
+            ### One test client per thread, like one connection per browser
+            if not hasattr(local, 'client'):
+                local.client = app.server.test_client()
+            response = local.client.post('/_dash-update-component', json=payload)
+            if response.status_code != 200:
+                raise RuntimeError(f'{response.status_code} for {payload["inputs"]}')
+        return call
+
+    scenarios = [
+        ('update_from_dropdown', 'direct', [direct_dropdown(s, d) for s, d in keys]),
+        ('update_from_dropdown', 'http', [http(dropdown_payload(s, d)) for s, d in keys]),
+        ('set_dropdown_from_map', 'direct', [direct_map(a) for a in aliases]),
+        ('set_dropdown_from_map', 'http', [http(map_payload(a)) for a in aliases]),
+    ]
+
+    header = f'{"callback":>22} {"via":>6} {"cache":>5} {"clients":>7} {"calls":>6} ' \
+             f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"req/s":>8}'
+    print(header)
+    print('-' * len(header))
+    worst_p95 = 0.0
+    for callback, via, calls in scenarios:
+        calls = calls * args.repeat
+        ### Only update_from_dropdown goes through the figure cache
+        caches = ['cold', 'warm'] if callback == 'update_from_dropdown' else ['-']
+        for cache in caches:
+            for clients in args.clients:
+                if cache == 'cold':
+                    app.render_cache = app.LRUCache(maxbytes=0)
+                elif cache == 'warm':
+                    app.render_cache = app.LRUCache(maxbytes=2**30)
+                    run(calls, 1)
+                latencies, wall = run(calls, clients)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+                worst_p95 = max(worst_p95, p95)
+                print(f'{callback:>22} {via:>6} {cache:>5} {clients:>7} {len(calls):>6} '
+                      f'{p50:8.2f} {p95:8.2f} {p99:8.2f} {len(calls) / wall:8.0f}')
+
+    if args.max_p95_ms is not None and worst_p95 > args.max_p95_ms:
+        print(f'p95 of {worst_p95:.2f} ms is above the limit of {args.max_p95_ms} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
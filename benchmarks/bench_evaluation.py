@@ -0,0 +1,82 @@
+"""
+Benchmark of the fold cache of "evaluate" in notebooks/trafficEvaluation.py.
+
+Evaluates Prophet and the copy baseline for synthetic stations on a shared fold plan,
+then again unchanged, after changing the parameters of one station and after adding a
+year of data to one station, and reports the time and number of recomputed folds of
+each run. Also checks the baseline against cross_val_baseline of trafficModules.
+
+    > python benchmarks/bench_evaluation.py --stations 3 --folds 4 --horizon 14
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'notebooks'))
+
+import trafficEvaluation as te
+import trafficForecast as tf
+import trafficModules as tm
+from common import make_hourly
+
+
+def station_series(df, stations):
+    df_y, df_missing = tf.daily_sums(df, stations)
+    return {zähl: tf.daily_frame(df_y, df_missing, zähl) for zähl in stations}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=3, help='number of stations')
+    parser.add_argument('--folds', type=int, default=4, help='number of cutoffs')
+    parser.add_argument('--horizon', type=int, default=14, help='days predicted after every cutoff')
+    parser.add_argument('--workers', type=int, default=1, help='processes for the model folds')
+    args = parser.parse_args()
+
+    stations = [1013 + i for i in range(args.stations)]
+    df = make_hourly(4, stations)
+    series = station_series(df, stations)
+    df_params = pd.DataFrame({'Zählstelle': stations, 'changepoint_prior_scale': 0.05, 'seasonality_prior_scale': 1.0,
+                              'holidays_prior_scale': 1.0, 'seasonality_mode': 'additive'})
+    cutoffs = te.fold_plan(series, args.horizon, n_folds=args.folds)
+
+    ### A year more of the first station, the folds up to the old end stay the same
+    more = make_hourly(5, stations[:1])
+    series_more = station_series(pd.concat([df, more[more.index >= df.index.max() + pd.Timedelta(hours=1)]]), stations)
+    df_params_changed = df_params.copy()
+    df_params_changed.loc[0, 'changepoint_prior_scale'] = 0.5
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, series_, df_params_ in [('cold cache', series, df_params),
+                                          ('unchanged', series, df_params),
+                                          ('params of one station', series, df_params_changed),
+                                          ('new data of one station', series_more, df_params_changed)]:
+            log = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(log):
+                df_report, df_pred = te.evaluate(series_, df_params_, cutoffs, args.horizon, cache_dir,
+                                                 workers=args.workers)
+            print(f'{name:>24}: {time.perf_counter() - start:6.2f} s, {log.getvalue().strip()}')
+
+    print(df_report.groupby('Zählstelle').mean().drop(columns='horizon').round(3).to_string())
+
+    ### The baseline folds equal those of cross_val_baseline on the interpolated series
+    for zähl in stations:
+        with contextlib.redirect_stdout(io.StringIO()):
+            df_base, _ = tm.cross_val_baseline(tm.InterpolateImputer().transform(series_more[zähl]),
+                                               cutoffs, args.horizon)
+        pred = df_pred[(df_pred.Zählstelle == zähl) & (df_pred.model == 'baseline')]
+        assert np.allclose(pred.yhat.to_numpy(), df_base.set_index('ds').loc[pred.ds, 'yhat'].to_numpy())
+    print('Baseline equals cross_val_baseline')
+
+
+if __name__ == '__main__':
+    main()
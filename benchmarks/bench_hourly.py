@@ -0,0 +1,93 @@
+"""
+Benchmark of the hourly mode of notebooks/trafficForecast.py and trafficModules.py.
+
+Builds the hour x station matrix of synthetic hourly counts with hourly_values and runs
+the same-weekday-same-hour baseline (cross_val_baseline_hourly) for weekly cutoffs,
+compared with a loop that copies a dataframe per station and cutoff, as the daily
+cross_val_baseline does. Checks that both give the same predictions and reports time
+and peak memory (the synthetic counts are noise, so the MAPE only compares runs).
+With --fit, also fits the hourly Prophet model of one station.
+
+    > python benchmarks/bench_hourly.py --years 11 --stations 16 --cutoffs 52 --horizon 168
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'notebooks'))
+
+import trafficForecast as tf
+import trafficModules as tm
+from common import make_hourly, measure
+
+
+def per_cutoff(df_hours, cutoffs, horizon, weeks):
+    """Baseline with a dataframe copy of the history and the test hours per station and cutoff."""
+    period = 7 * 24
+    weeksback = (horizon - 1) // period + 1
+    preds = []
+    for zähl in df_hours.columns:
+        y = df_hours[zähl].rename('y').reset_index()
+        for cutoff in cutoffs:
+            end = pd.Timestamp(cutoff) + pd.Timedelta(days=1)
+            y_train = y[y.ds < end].copy()
+            y_test = y[(y.ds >= end) & (y.ds < end + pd.Timedelta(hours=horizon))].copy()
+            past = [y_train.y.to_numpy()[len(y_train) - period * (weeksback + k):][:horizon] for k in range(weeks)]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                y_test['yhat'] = np.nanmean(past, axis=0)
+            preds.append(y_test.assign(Zählstelle=zähl, cutoff=cutoff))
+    return pd.concat(preds, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=11, help='years of hourly data')
+    parser.add_argument('--stations', type=int, default=16, help='number of stations')
+    parser.add_argument('--cutoffs', type=int, default=52, help='weekly cutoffs at the end of the data')
+    parser.add_argument('--horizon', type=int, default=168, help='hours predicted after every cutoff')
+    parser.add_argument('--weeks', type=int, default=4, help='weeks averaged by the baseline')
+    parser.add_argument('--fit', action='store_true', help='also fit the hourly Prophet model of one station')
+    args = parser.parse_args()
+
+    stations = [1013 + i for i in range(args.stations)]
+    df = make_hourly(args.years, stations)
+    print(f'{len(df)} hourly rows of {args.stations} stations')
+
+    df_hours, elapsed, peak = measure(tf.hourly_values, df, quiet=True)
+    print(f'{"hourly_values":>26}: {elapsed:6.2f} s, peak {peak / 2**20:6.1f} MB, '
+          f'matrix {df_hours.memory_usage().sum() / 2**20:.1f} MB')
+
+    last = df_hours.index.max().normalize() - pd.Timedelta(days=args.horizon // 24 + 2)
+    cutoffs = pd.date_range(end=last, periods=args.cutoffs, freq='7D')
+    for weeks in sorted({1, args.weeks}):
+        (df_pred, df_metrics), elapsed, peak = measure(tm.cross_val_baseline_hourly, df_hours, cutoffs,
+                                                       args.horizon, weeks, quiet=True)
+        print(f'{f"strided, {weeks} weeks":>26}: {elapsed:6.2f} s, peak {peak / 2**20:6.1f} MB, '
+              f'mean MAPE {df_metrics.MAPE.mean():.3f}')
+        df_loop, elapsed, peak = measure(per_cutoff, df_hours, cutoffs, args.horizon, weeks, quiet=True)
+        print(f'{f"per cutoff, {weeks} weeks":>26}: {elapsed:6.2f} s, peak {peak / 2**20:6.1f} MB')
+
+        df_loop = df_loop.dropna(subset=['y'])
+        merged = df_pred.merge(df_loop, on=['Zählstelle', 'cutoff', 'ds'], suffixes=('', '_loop'))
+        assert len(merged) == len(df_pred) == len(df_loop)
+        assert np.allclose(merged.yhat, merged.yhat_loop, equal_nan=True)
+    print('Strided baseline equals the per-cutoff loop')
+
+    if args.fit:
+        params = {'changepoint_prior_scale': 0.05, 'seasonality_prior_scale': 1.0,
+                  'holidays_prior_scale': 1.0, 'seasonality_mode': 'additive'}
+        start = time.perf_counter()
+        _, df_fc = tf.model_station_hours(params, df_hours, stations[0], cutoffs[-1], horizon=args.horizon)
+        mape = (np.abs(df_fc.y - df_fc.yhat) / df_fc.y.abs()).mean()
+        print(f'{"Prophet, 8 weeks hourly":>26}: {time.perf_counter() - start:6.2f} s, MAPE {mape:.3f}')
+
+
+if __name__ == '__main__':
+    main()
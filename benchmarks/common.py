@@ -0,0 +1,51 @@
+"""
+Helpers shared by the benchmark scripts: timing and peak memory of a call, and a
+synthetic hourly dataset like the compiled Zählstelle csv.
+"""
+import contextlib
+import io
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+def measure(func, *args, quiet=False):
+    """
+    Returns the result, wall time and peak python memory of func(*args). Memory is
+    traced in a second call, so the tracing overhead does not distort the timing.
+    With quiet=True, what func prints is dropped.
+    """
+    with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def make_hourly(years, stations, seed=0):
+    """
+    Hourly dataframe like the compiled csv: datetime index, Zählstelle, PKW, LKW, Gesamt.
+    Every station starts and ends at a different hour, some hours are missing entirely
+    and some have NaN counts.
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i, station in enumerate(stations):
+        hours = pd.date_range(f'{2012 + i % 3}-01-01 {i}:00', f'{2011 + years}-12-31 {23 - i}:00', freq='h')
+        hours = hours[rng.random(len(hours)) > 0.01]
+        pkw = rng.integers(50, 3000, len(hours)).astype('float64')
+        lkw = rng.integers(0, 300, len(hours)).astype('float64')
+        gesamt = pkw + lkw
+        gesamt[rng.random(len(hours)) < 0.01] = np.nan
+        ### A few whole days without data
+        gesamt[(hours.dayofyear == 100 + i) & (hours.year % 2 == 0)] = np.nan
+        frames.append(pd.DataFrame({'Zählstelle': station, 'PKW': pkw, 'LKW': lkw, 'Gesamt': gesamt},
+                                   index=pd.DatetimeIndex(hours, name='datetime')))
+    return pd.concat(frames)
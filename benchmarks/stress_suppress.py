@@ -0,0 +1,276 @@
+"""
+Stress check of suppress_stdout_stderr in notebooks/trafficModules.py.
+
+Runs 10k suppressed stand-in calls (printing from python and writing to the file
+descriptors 1 and 2 directly, like cmdstan does) sequentially, nested from several
+threads, with a bounded capture and in a process pool that suppresses once per worker.
+The open file limit is lowered first, so a leak of descriptors fails within a few
+hundred calls. Checks that no descriptor is left open and reports the cost per call.
+Before that, asserts that nesting leaves the descriptors and the real output as they were,
+that the output is restored when an exception is raised inside the suppression and that
+pool workers forked during a suppression start with a fresh one, and that running out
+of descriptors while redirecting raises, leaks nothing and leaves no suppression behind.
+With --fits n, n real Prophet fits on a small synthetic series are run the same way.
+
+    > python benchmarks/stress_suppress.py --calls 10000 --fits 20
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'notebooks'))
+
+import trafficModules as tm
+
+FD_LIMIT = 256
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def stand_in(i=0):
+    print(f'Chain [1] start processing {i}')
+    print(f'Chain [1] done processing {i}', file=sys.stderr)
+    os.write(1, f'cmdstan stdout {i}\n'.encode())
+    os.write(2, f'cmdstan stderr {i}\n'.encode())
+
+
+def fit_prophet(df):
+    from prophet import Prophet
+    m = Prophet(daily_seasonality=False)
+    m.fit(df)
+
+
+def pool_task(i):
+    with tm.suppress_stdout_stderr():
+        with tm.suppress_stdout_stderr():
+            stand_in(i)
+    return os.getpid(), open_fds()
+
+
+def real_output(func):
+    """Runs func with the descriptors 1 and 2 pointed to a temporary file, returns func's
+    result and what reached them."""
+    tm._flush_std()
+    saved = os.dup(1), os.dup(2)
+    with tempfile.TemporaryFile() as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            result = func()
+        finally:
+            tm._flush_std()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+        f.seek(0)
+        return result, f.read().decode()
+
+
+def assert_idle():
+    cls = tm.suppress_stdout_stderr
+    assert cls._depth == 0 and cls._saved_fds is None and cls._capture is None, \
+        f'suppression left in effect: depth {cls._depth}, saved {cls._saved_fds}'
+    assert cls._lock.acquire(blocking=False), 'suppression lock left held'
+    cls._lock.release()
+
+
+def check_nesting():
+    def run():
+        before = open_fds()
+        with tm.suppress_stdout_stderr():
+            stand_in(0)
+            with tm.suppress_stdout_stderr():
+                stand_in(1)
+                with tm.suppress_stdout_stderr():
+                    stand_in(2)
+            stand_in(3)
+        stand_in('after')
+        return before, open_fds()
+    (before, after), output = real_output(run)
+    assert after == before, f'open fds {before} -> {after} after nesting'
+    assert_idle()
+    assert 'processing 3' not in output and 'cmdstan stderr 2' not in output, f'suppressed output leaked: {output!r}'
+    assert output.count('after') == 4, f'output not restored after nesting: {output!r}'
+
+
+def check_exception():
+    def run():
+        before = open_fds()
+        try:
+            with tm.suppress_stdout_stderr():
+                with tm.suppress_stdout_stderr(capture=4096):
+                    stand_in(0)
+                    raise KeyError('inside')
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('the exception was swallowed')
+        stand_in('after')
+        return before, open_fds()
+    (before, after), output = real_output(run)
+    assert after == before, f'open fds {before} -> {after} after an exception'
+    assert_idle()
+    assert 'processing 0' not in output, f'suppressed output leaked: {output!r}'
+    assert output.count('after') == 4, f'output not restored after an exception: {output!r}'
+
+
+def check_exhausted():
+    ### The outermost `with` needs 3 descriptors (4 with a capture), fail it at each one
+    for capture, needed in [(0, 3), (4096, 4)]:
+        for free in range(needed):
+            before = open_fds()
+            fillers = []
+            try:
+                while True:
+                    fillers.append(os.open(os.devnull, os.O_RDONLY))
+            except OSError:
+                pass
+            for fd in fillers[len(fillers) - free:]:
+                os.close(fd)
+            del fillers[len(fillers) - free:]
+            try:
+                with tm.suppress_stdout_stderr(capture):
+                    raise AssertionError(f'redirected with {free} free descriptors')
+            except OSError:
+                pass
+            finally:
+                for fd in fillers:
+                    os.close(fd)
+            assert_idle()
+            assert open_fds() == before, f'open fds {before} -> {open_fds()} with {free} free descriptors'
+            ### The next suppression must work again
+            def suppressed():
+                with tm.suppress_stdout_stderr():
+                    stand_in(free)
+            _, output = real_output(suppressed)
+            assert output == '', f'not suppressed after running out of descriptors: {output!r}'
+            assert_idle()
+
+
+def fork_task(i):
+    cls = tm.suppress_stdout_stderr
+    state = cls._depth, cls._saved_fds, cls._capture is None, cls._lock.acquire(blocking=False)
+    cls._lock.release()
+    stdout = os.readlink('/proc/self/fd/1')
+    os.write(1, f'worker {i}\n'.encode())
+    before = open_fds()
+    with tm.suppress_stdout_stderr():
+        stand_in(i)
+    return state, stdout, before, open_fds()
+
+
+def check_fork():
+    ### Workers forked while the parent suppresses with a capture (its reader thread doesn't exist in them)
+    def run():
+        stdout = os.readlink('/proc/self/fd/1')
+        with tm.suppress_stdout_stderr(capture=4096) as suppressed:
+            with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(fork_task, range(8)))
+            os.write(1, b'parent suppressed\n')
+        return stdout, results, suppressed.output
+    (stdout, results, captured), output = real_output(run)
+    for state, worker_stdout, before, after in results:
+        assert state == (0, None, True, True), f'worker inherited the suppression: {state}'
+        assert worker_stdout == stdout, f'worker stdout {worker_stdout}, not the real {stdout}'
+        assert after == before, f'open fds {before} -> {after} in a worker'
+    assert all(f'worker {i}\n' in output for i in range(8)), f'worker output missing: {output!r}'
+    assert 'worker' not in captured and 'cmdstan' not in captured, f'worker output captured: {captured!r}'
+    assert captured == 'parent suppressed\n' and 'parent' not in output
+    assert_idle()
+
+
+def check(name, calls, func):
+    before = open_fds()
+    start = time.perf_counter()
+    extra = func()
+    elapsed = time.perf_counter() - start
+    after = open_fds()
+    ### Nothing must have leaked out of the suppression: this goes to the real stdout
+    print(f'{name:>28}: {calls:6d} calls, {elapsed / calls * 1e6:8.1f} µs per call, '
+          f'open fds {before} -> {after}{extra or ""}', flush=True)
+    assert after == before, f'{after - before} file descriptors leaked'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=10_000, help='stand-in calls per check')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the threaded check')
+    parser.add_argument('--fits', type=int, default=0, help='real Prophet fits')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(FD_LIMIT, hard), hard))
+    print(f'Open file limit lowered to {min(FD_LIMIT, hard)}')
+
+    for name, func in [('nesting', check_nesting), ('exception', check_exception), ('fork', check_fork),
+                       ('out of descriptors', check_exhausted)]:
+        func()
+        print(f'{name:>28}: ok', flush=True)
+
+    def sequential():
+        for i in range(args.calls):
+            with tm.suppress_stdout_stderr():
+                stand_in(i)
+    check('sequential', args.calls, sequential)
+
+    def threaded():
+        def run(offset):
+            for i in range(offset, args.calls, args.threads):
+                with tm.suppress_stdout_stderr():
+                    with tm.suppress_stdout_stderr():
+                        stand_in(i)
+        threads = [threading.Thread(target=run, args=(t,)) for t in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    check(f'nested, {args.threads} threads', args.calls, threaded)
+
+    def captured():
+        with tm.suppress_stdout_stderr(capture=4096) as suppressed:
+            for i in range(args.calls):
+                with tm.suppress_stdout_stderr():
+                    stand_in(i)
+        assert len(suppressed.output.encode()) <= 4096
+        assert suppressed.output.endswith(f'cmdstan stderr {args.calls - 1}\n')
+        return f', kept the last {len(suppressed.output.encode())} bytes'
+    check('captured, 4 kB buffer', args.calls, captured)
+
+    def pooled():
+        with ProcessPoolExecutor(max_workers=2, initializer=tm.suppress_in_worker) as pool:
+            results = list(pool.map(pool_task, range(args.calls), chunksize=100))
+        ### Every worker keeps its descriptors from its first to its last task
+        per_worker = {}
+        for pid, fds in results:
+            per_worker.setdefault(pid, set()).add(fds)
+        assert all(len(fds) == 1 for fds in per_worker.values()), f'open fds in the workers: {per_worker}'
+        return f', constant in every worker'
+    check('pool, suppressed per worker', args.calls, pooled)
+
+    if args.fits:
+        days = pd.date_range('2020-01-01', periods=400, freq='D')
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({'ds': days, 'y': 1000 + 200 * (days.weekday < 5) + rng.normal(0, 50, len(days))})
+
+        def fits():
+            for _ in range(args.fits):
+                with tm.suppress_stdout_stderr():
+                    fit_prophet(df)
+        check('Prophet fits', args.fits, fits)
+
+
+if __name__ == '__main__':
+    main()
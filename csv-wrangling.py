@@ -1,90 +1,490 @@
 import pandas as pd
 import numpy as np
 import re
+import os
+import sys
+import argparse
+import datetime
+import functools
+import glob
+import hashlib
+import importlib.util
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-def read_zählstellen(filename):
+### The storage layout is shared with the notebooks. trafficStore is loaded from its file,
+### so the notebooks folder is not put on the import path of whoever imports this script
+def _load_module(name, path):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    ### Registered, so the process pool can pickle by reference what comes from it
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+trafficStore = _load_module('trafficStore', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         'notebooks', 'trafficStore.py'))
+
+### Grammar of the lines of a table, shared by both parsers (quotes removed):
+### - a heading "Zählstelle <number> ..." (the umlaut is not always encoded the same way)
+###   starts a table. Its station number follows "Zählstelle" and the date is in the third
+###   field, as "1.1" or as "1,1" (day and month in separate fields), followed by the year.
+### - a row is an hour H:00, HH:00 or 24:00:00, followed by the counts PKW, LKW and Gesamt,
+###   each digits or blank, and nothing but empty fields after them.
+### - any other line starting with a digit is a malformed row, all other lines are skipped.
+HEADING = r"Z[^,\n]*?hlstelle"
+HEADER = HEADING + r"[ \t]+(\d+)[^,\n]*,[^,\n]*,[ \t]*(\d{1,2})[ \t]*[.,][ \t]*(\d{1,2})[ \t]*,[ \t]*(\d{4})"
+COUNT = r"[ \t]*(\d*)[ \t]*"
+ROW = r"(\d{1,2}):00(?::00)?," + COUNT + "," + COUNT + "," + COUNT + r",*\r?$"
+
+### Line-by-line parser: one pattern per kind of line
+HEADING_RE = re.compile(HEADING)
+HEADER_RE = re.compile(HEADER)
+ROW_RE = re.compile(ROW)
+
+### Chunked parser: one pattern applied once to a whole block of lines, giving a tuple of
+### (heading, hour, PKW, LKW, Gesamt, malformed row) for every line that is not skipped
+LINE_RE = re.compile(r"^(?:(" + HEADING + r"[^\n]*)|" + ROW + r"|(\d[^\n]*))", re.M)
+
+COLUMNS = ['Zählstelle','PKW','LKW','Gesamt']
+
+
+class ParseReport:
+    """
+    What the parsers did with the lines of a file, counted while parsing: tables and rows
+    read, lines skipped (blank lines, column names, sums), malformed headings and rows
+    (dropped, as are rows below a malformed heading), rows with a blank count (kept as
+    <NA>), rows of hour 24 and the tables that do not have 24 rows.
+    """
+    def __init__(self):
+        self.lines = 0
+        self.tables = 0
+        self.rows = 0
+        self.skipped = 0
+        self.malformed_headers = 0
+        self.malformed_rows = 0
+        self.rows_outside_tables = 0
+        self.blank_counts = 0
+        self.hour24 = 0
+        ### (station, date, rows) of every table without 24 rows
+        self.incomplete = []
+
+    def check_table(self, station, date, rows):
+        if rows != 24:
+            self.incomplete.append((int(station), str(date)[:10], int(rows)))
+
+    def __str__(self):
+        text = (f"{self.lines} lines: {self.tables} tables, {self.rows} rows, {self.skipped} other lines skipped\n"
+                f"  dropped: {self.malformed_headers} malformed headings, {self.malformed_rows} malformed rows, "
+                f"{self.rows_outside_tables} rows outside a table\n"
+                f"  {self.blank_counts} rows with blank counts\n"
+                f"  {self.hour24} rows of 24:00, stamped 23:30 of the day of their table (no rollover to the next day)\n"
+                f"  {len(self.incomplete)} tables without 24 rows")
+        if self.incomplete:
+            text += ': ' + ', '.join(f'{station} {date} ({rows} rows)' for station, date, rows in self.incomplete[:5])
+            text += ', ...' if len(self.incomplete) > 5 else ''
+        return text
+
+
+@functools.lru_cache(maxsize=None)
+def _is_date(day, mon, year):
+    try:
+        datetime.date(int(year), int(mon), int(day))
+    except ValueError:
+        return False
+    return True
+
+
+def read_zählstellen(filename, report=None):
     """
     Returns a single dataframe from the traffic Zähstelle csvs, which have data in multiple tables 
     separated by irregular headings. See calling function below "import_export_multiple".
+    Every line is classified once by its first character and one compiled pattern. The counts
+    of skipped and malformed lines are collected in report (a ParseReport) and printed.
     """
-
+    report = ParseReport() if report is None else report
     lst = []
-    i=0
-    
+    ### State: station and date of the current table (None before the first heading and
+    ### after a malformed one) and the number of its rows so far
+    zählstelle, datestr, n_rows = None, None, 0
+
     with open(filename, newline='') as csvfile:
-        while True:
-            # Continue reading lines until empty str is returned, then print EOF and number of lines
-            newline = csvfile.readline()
-            i +=1 
-            if not newline:
-                print("EOF, line: ", i)
-                break    
-            
-            #Split the newline into list of strings based on ',' delimiter
-            newline = newline.rstrip('\n').replace('"',"").split(",")
-            
+        for line in csvfile:
+            report.lines += 1
+            line = line.rstrip('\r\n').replace('"', "")
+            first = line[:1]
+
             # a line starts with Zählstelle -> implies that a new table of 24hrs is starting
-            if bool(re.match(r"Z.*?hlstelle",newline[0])):
-                # Record the number of the zähstelle
-                zählstelle = re.match(r"Z.*?hlstelle",newline[0]).string.split()[1]
-
-                ### Some day/month strings are in the format 1.1, some are in the format 1,1. 
-                # Use this try-except block to find day and month
-                try:
-                    [day,mon] = newline[2].replace(' ','').split(".")
-                    year   = newline[3][:4]
-                except:
-                    [day,mon] = newline[2:4]
-                    year   = newline[4][:4]
-
-                #Pad the numbers with 0s after removing spaces   
-                day = day.replace(" ","").zfill(2)
-                mon = mon.replace(" ","").zfill(2) 
-
-                ## Make datestring in format DD.MM.YYYY
-                datestr = day + '.' +  mon + '.' + year
+            if first == 'Z' and HEADING_RE.match(line):
+                if zählstelle is not None:
+                    report.check_table(zählstelle, datestr, n_rows)
+                header = HEADER_RE.match(line)
+                if header is None or not _is_date(*header.groups()[1:]):
+                    report.malformed_headers += 1
+                    zählstelle = None
+                    continue
+                zählstelle, day, mon, year = header.groups()
+                ## Make datestring in format YYYY-MM-DD
+                datestr = year + '-' + mon.zfill(2) + '-' + day.zfill(2)
+                n_rows = 0
+                report.tables += 1
 
             # Collect entries from the table, which start either with format H:00 or HH:00
-            if bool(re.match(r"\d{1,2}:00",newline[0])):
-                lst.append([zählstelle] + [datestr] +  newline)
+            elif '0' <= first <= '9':
+                row = ROW_RE.match(line)
+                if row is None or not 1 <= int(row.group(1)) <= 24:
+                    report.malformed_rows += 1
+                elif zählstelle is None:
+                    report.rows_outside_tables += 1
+                else:
+                    hour, pkw, lkw, gesamt = row.groups()
+                    lst.append([zählstelle, datestr, hour, pkw, lkw, gesamt])
+                    n_rows += 1
+                    report.hour24 += hour == '24'
+                    report.blank_counts += not (pkw and lkw and gesamt)
 
-            
+            else:
+                report.skipped += 1
 
+    if zählstelle is not None:
+        report.check_table(zählstelle, datestr, n_rows)
+    report.rows += len(lst)
+    print(report)
 
     ## Make into dataframe with appropriate columns
-    df = pd.DataFrame(lst, columns = ['Zählstelle','Date','Time','PKW','LKW','Gesamt'])
-
-    ## Replace times with irregular numbers of digits
-    df.Time.where(df.Time != '24:00:00', '24:00', inplace=True)
-    ## Convert end of time to middle of hour
-    df.Time = df.Time.transform(lambda x: str(int(x.split(":")[0]) - 1).zfill(2) + ':30')
-    df['datetime'] = pd.to_datetime(df.Date + ' ' + df.Time, format='%d.%m.%Y %H:%M')
-    ## Add one day to midnight values
-    # df.Datetime.where(df.Datetime.dt.hour != 0, df.Datetime + pd.DateOffset(days=1), inplace=True)
-    df.drop(['Date','Time'],axis=1, inplace=True)
+    df = pd.DataFrame(lst, columns = ['Zählstelle','Date','Hour','PKW','LKW','Gesamt'])
+
+    ## The end of hour H (24 included) becomes the middle of the hour, (H-1):30 of the same day
+    minutes = pd.to_timedelta(df.Hour.astype('int64') * 60 - 30, unit='m')
+    df['datetime'] = pd.to_datetime(df.Date, format='%Y-%m-%d') + minutes
+    df.drop(['Date','Hour'],axis=1, inplace=True)
     df.set_index('datetime', inplace=True)
 
 
     return df
 
-def import_export_multiple(list_cvs, outfile):
+def _parse_headers(headers):
+    """
+    Returns station numbers and dates (datetime64) for a Series of table headings, read
+    with the HEADER grammar of the line-by-line parser. Malformed headings get the
+    station None and the date NaT.
+    """
+    if len(headers) == 0:
+        return np.array([], dtype=object), np.array([], dtype='datetime64[ns]')
+    parts = headers.str.extract('^' + HEADER)
+    stations = pd.to_numeric(parts[0], errors='coerce')
+    dates = pd.to_datetime(pd.DataFrame({'year': pd.to_numeric(parts[3], errors='coerce'),
+                                         'month': pd.to_numeric(parts[2], errors='coerce'),
+                                         'day': pd.to_numeric(parts[1], errors='coerce')}), errors='coerce')
+    valid = stations.notna() & dates.notna()
+    stations = stations.astype('Int64').astype(object).where(valid, None)
+    return stations.to_numpy(dtype=object), dates.where(valid).to_numpy(dtype='datetime64[ns]')
+
+
+def _to_counts(values):
+    """
+    Converts an array of count strings (digits or blank, see COUNT) to int32. Blank counts
+    become <NA>, which only costs the slower conversion for blocks that contain any. enforce_schema
+    then checks that they fit uint16.
+    """
+    try:
+        return pd.array(values.astype('int32'), dtype='Int32')
+    except ValueError:
+        return pd.array(pd.to_numeric(values, errors='coerce'), dtype='Int32')
+
+
+def iter_zählstellen(filename, chunksize=2_000_000, report=None):
+    """
+    Streams a traffic Zählstelle csv in blocks of about `chunksize` characters and yields one dataframe
+    per block in the compact schema of trafficStore.SCHEMA: int16 Zählstelle, uint16 counts and a
+    datetime64 index.
+    Same output as "read_zählstellen", but lines are classified and converted with
+    vectorised string operations instead of one regex call per line. The same counts of
+    skipped and malformed lines are collected in report (a ParseReport) on the way.
+    """
+    report = ParseReport() if report is None else report
+    ### Station and date of the last table heading and its number of rows so far,
+    ### carried over between blocks
+    station, date, carried_rows = None, None, 0
+
+    with open(filename, newline='') as csvfile:
+        while True:
+            ### Read a block of characters and complete its last line
+            text = csvfile.read(chunksize)
+            if not text:
+                break
+            text += csvfile.readline()
+            text = text.replace('"', "")
+
+            ### One regex pass over the block, every matching line gives a tuple of
+            ### (heading, hour, PKW, LKW, Gesamt, malformed row) with empty strings for
+            ### the other kinds. The lines that do not match are skipped
+            found = LINE_RE.findall(text)
+            n_lines = text.count('\n') + (not text.endswith('\n'))
+            report.lines += n_lines
+            report.skipped += n_lines - len(found)
+            if not found:
+                continue
+            headers, hours, pkw, lkw, gesamt, malformed = (np.array(col, dtype=object) for col in zip(*found))
+            is_header = headers != ""
+            is_row = hours != ""
+            report.malformed_rows += int((malformed != "").sum())
+
+            stations, dates = _parse_headers(pd.Series(headers[is_header], dtype=object))
+            report.tables += int(pd.notna(stations).sum())
+            report.malformed_headers += int(pd.isna(stations).sum())
+            ### Prepend the heading carried over from the previous block, so rows at the
+            ### start of this block can be matched to it
+            stations = np.concatenate([np.array([station], dtype=object), stations])
+            dates = np.concatenate([np.array([date], dtype='datetime64[ns]'), dates])
+            station, date = stations[-1], dates[-1]
+
+            ### Index of the last heading above every row, keep only rows of an hour 1-24
+            ### below a heading
+            which = np.cumsum(is_header)[is_row]
+            rows = np.flatnonzero(is_row)
+            hour = hours[rows].astype('int64')
+            valid = (hour >= 1) & (hour <= 24)
+            known = pd.notna(stations[which])
+            report.malformed_rows += int((~valid).sum())
+            report.rows_outside_tables += int((valid & ~known).sum())
+            keep = valid & known
+            rows, which, hour = rows[keep], which[keep], hour[keep]
+
+            ### Rows per table, every table but the last is complete within this block
+            counts = np.bincount(which, minlength=len(stations))
+            counts[0] += carried_rows
+            for t in np.flatnonzero(counts[:-1] != 24):
+                if pd.notna(stations[t]):
+                    report.check_table(stations[t], dates[t], counts[t])
+            carried_rows = counts[-1]
+            if len(rows) == 0:
+                continue
+
+            ### End of hour H:00 (or 24:00:00) becomes the middle of the hour, (H-1):30
+            report.rows += len(rows)
+            report.hour24 += int((hour == 24).sum())
+            minutes = hour * 60 - 30
+            index = dates[which] + minutes.astype('timedelta64[m]')
+
+            df = pd.DataFrame({'Zählstelle': stations[which].astype('int64')},
+                              index=pd.DatetimeIndex(index, name='datetime'))
+            for col, values in zip(COLUMNS[1:], [pkw, lkw, gesamt]):
+                df[col] = _to_counts(values[rows])
+            report.blank_counts += int(df[COLUMNS[1:]].isna().any(axis=1).sum())
+
+            yield trafficStore.enforce_schema(df)
+
+    if station is not None:
+        report.check_table(station, date, carried_rows)
+
+
+def read_zählstellen_chunked(filename, chunksize=2_000_000, report=None):
+    """
+    Returns a single dataframe from the blocks yielded by "iter_zählstellen" and prints
+    the ParseReport of the file (also filled into report, if given).
+    """
+    report = ParseReport() if report is None else report
+    blocks = list(iter_zählstellen(filename, chunksize=chunksize, report=report))
+    print(report)
+    if not blocks:
+        empty = pd.DataFrame({col: [] for col in COLUMNS}, index=pd.DatetimeIndex([], name='datetime'))
+        return trafficStore.enforce_schema(empty)
+
+    df = pd.concat(blocks)
+    print("EOF, rows: ", len(df))
+
+    return df
+
+
+def _read_as_csv(filename, header):
+    """
+    Parses one file with "read_zählstellen_chunked" and returns it formatted as csv text.
+    Runs inside the worker processes of "import_export_multiple", so the formatting is
+    parallel as well and the main process only has to write.
+    """
+    print(f'Processing {filename}')
+    df = read_zählstellen_chunked(filename)
+    return df.to_csv(header=header), _usage(df)
+
+
+def _source_entry(filename, df):
+    """
+    Returns the manifest entry of a parsed source file: size, mtime, sha1 and the
+    ingested time range of every station in it.
+    """
+    entry = _file_signature(filename)
+    entry['sha1'] = _sha1(filename)
+    entry['stations'] = trafficStore.station_ranges(df)
+    return entry
+
+
+def _usage(df):
+    """
+    Returns the number of rows and the bytes per column of a parsed file, for the memory
+    report of the ingest (trafficStore.memory_report).
+    """
+    return len(df), df.memory_usage(deep=True)
+
+
+def _print_usage(usages):
+    rows = sum(n for n, _ in usages)
+    usage = sum(u for _, u in usages) if usages else pd.Series(dtype='int64')
+    print(trafficStore.memory_report(usage, rows))
+
+
+def _file_signature(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _read_as_parquet(filename, root):
+    """
+    Parses one file with "read_zählstellen_chunked" and writes it into the partitioned
+    parquet dataset at root. Every year of a station is a partition of its own, so
+    workers never write into the same files. Returns the manifest entry of the file.
+    """
+    print(f'Processing {filename}')
+    df = read_zählstellen_chunked(filename)
+    name = os.path.splitext(os.path.basename(filename))[0]
+    trafficStore.write_partitioned(df, root, name=name)
+    return _source_entry(filename, df), _usage(df)
+
+
+def _read_for_upsert(filename):
+    """
+    Parses one file with "read_zählstellen_chunked" and returns it with its manifest entry.
+    The upsert itself happens in the main process, as files may share partitions.
+    """
+    print(f'Processing {filename}')
+    df = read_zählstellen_chunked(filename)
+    return df, _source_entry(filename, df)
+
+
+def _in_order(func, jobs, workers):
+    """
+    Yields func(*job) for every job in order. With workers > 1 the jobs run in a process
+    pool, with at most `workers` jobs submitted ahead of the one that is yielded next.
+    """
+    jobs = iter(jobs)
+
+    if workers <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque(pool.submit(func, *job) for job in islice(jobs, workers))
+        while pending:
+            result = pending.popleft().result()
+            for job in islice(jobs, 1):
+                pending.append(pool.submit(func, *job))
+            yield result
+
+
+def import_export_multiple(list_cvs, outfile, workers=1, fmt='csv'):
     ''' 
-    Imports mutiple csvs using read_zähstellen function, concatenates and writes to a single csv.
+    Imports mutiple csvs using read_zählstellen_chunked function and writes them to a single csv.
+    With workers > 1 the files are parsed in a process pool. Each file is appended to outfile
+    as soon as it and all files before it are done, so the output order is that of list_cvs
+    and only a few files are held in memory at once.
+    With fmt='parquet', outfile is the root directory of a parquet dataset partitioned by
+    station and year instead, see trafficStore.read_partitioned for reading it.
+    Prints the memory the parsed rows took in the compact schema (trafficStore.SCHEMA);
+    read the csv with trafficStore.read_compiled_csv to get that schema back.
     '''
-    lst_dataframes = []
-    for filename in list_cvs:
-        print(f'Processing {filename}')
-        df = read_zählstellen(filename)
-        lst_dataframes.append(df)
+    if fmt == 'parquet':
+        ### A rebuild starts from scratch, files of an earlier build would duplicate rows
+        if os.path.exists(os.path.join(outfile, trafficStore.MANIFEST)):
+            shutil.rmtree(outfile)
+        manifest = {}
+        usages = []
+        jobs = [(filename, outfile) for filename in list_cvs]
+        for filename, (entry, usage) in zip(list_cvs, _in_order(_read_as_parquet, jobs, workers)):
+            manifest[os.path.basename(filename)] = entry
+            usages.append(usage)
+        trafficStore.write_manifest(outfile, manifest)
+        _print_usage(usages)
+        return
 
-    df = pd.concat(lst_dataframes)
+    usages = []
+    jobs = [(filename, i == 0) for i, filename in enumerate(list_cvs)]
+    with open(outfile, 'w', newline='') as f:
+        for text, usage in _in_order(_read_as_csv, jobs, workers):
+            f.write(text)
+            usages.append(usage)
+    _print_usage(usages)
 
-    df.to_csv(outfile)
 
+def import_incremental(list_cvs, root, workers=1):
+    '''
+    Brings the parquet dataset at root up to date with list_cvs. Files listed in the
+    manifest with the same size and mtime, or with a different mtime but the same sha1,
+    are skipped. New or changed files are parsed (in a process pool with workers > 1)
+    and upserted, so a nightly run only costs the files that were added. The rows a
+    changed file contributed before (its station ranges in the manifest) are deleted
+    first, so rows its new version no longer has do not stay in the dataset.
+    Returns the list of files that were ingested.
+    '''
+    manifest = trafficStore.read_manifest(root)
 
-if __name__ == "__main__":
-    list_files = ['./data/Anfrage_SWiesner_' + str(year) + '.csv' for year in range(2012,2023)]
-    import_export_multiple(list_files, './data/compiled-zähstellen.csv')
+    changed = []
+    for filename in list_cvs:
+        entry = manifest.get(os.path.basename(filename))
+        signature = _file_signature(filename)
+        if entry is None:
+            changed.append(filename)
+        elif (entry['size'], entry['mtime']) != (signature['size'], signature['mtime']):
+            if entry['sha1'] == _sha1(filename):
+                ### Touched, but the content is the same
+                entry.update(signature)
+            else:
+                changed.append(filename)
+
+    usages = []
+    for filename, (df, entry) in zip(changed, _in_order(_read_for_upsert, [(f,) for f in changed], workers)):
+        usages.append(_usage(df))
+        previous = manifest.get(os.path.basename(filename))
+        trafficStore.upsert_partitioned(df, root, replace=previous['stations'] if previous else None)
+        manifest[os.path.basename(filename)] = entry
+        ### Record every file as soon as it is stored, an interrupted run resumes from there
+        trafficStore.write_manifest(root, manifest)
 
+    trafficStore.write_manifest(root, manifest)
+    print(f'Ingested {len(changed)} of {len(list_cvs)} files')
+    if usages:
+        _print_usage(usages)
+    return changed
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile the yearly Zählstelle csvs into a single csv.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of files parsed in parallel (default: 1)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='write a single csv, or a parquet dataset partitioned by station and year')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only ingest new or changed files into the parquet dataset')
+    args = parser.parse_args()
+
+    list_files = ['./data/Anfrage_SWiesner_' + str(year) + '.csv' for year in range(2012,2023)]
+    if args.incremental:
+        ### Picks up any newly downloaded export next to the yearly files
+        list_files = sorted(glob.glob('./data/Anfrage_*.csv'))
+        import_incremental(list_files, './data/compiled-zaehlstellen', workers=args.workers)
+    elif args.format == 'parquet':
+        import_export_multiple(list_files, './data/compiled-zaehlstellen', workers=args.workers, fmt='parquet')
+    else:
+        import_export_multiple(list_files, './data/compiled-zähstellen.csv', workers=args.workers)
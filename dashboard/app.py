@@ -1,15 +1,37 @@
+import time
+startup_begin = time.perf_counter()
+
 import dash
 import os
-from dash import dcc, html
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dash import dcc, html, Patch
 import dash_bootstrap_components as dbc
 from dash import html
 import plotly.graph_objects as go
 from dash.dependencies import Input, Output
 import pandas as pd
 import plotly.io as pio
-from simple_dwd_weatherforecast import dwdforecast
-from datetime import datetime, timedelta, timezone, date
+from datetime import date
 from dotenv import load_dotenv
+import flask
+
+import predstore
+import weather
+from weekdaystats import WeekdayStats
+from stationindex import StationIndex
+from metrics import Metrics
+
+# Duration of the startup steps, reported once the app is ready
+startup_times = {}
+
+@contextmanager
+def startup_step(name):
+    start = time.perf_counter()
+    yield
+    startup_times[name] = time.perf_counter() - start
 
 pio.templates.default = "plotly_white"
 external_stylesheets = [dbc.themes.SKETCHY]
@@ -34,17 +56,55 @@ app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
 # this is needed by gunicorn command in procfile
 server = app.server
 
+# Timing spans and payload sizes, off unless DASH_METRICS is set, e.g.
+# DASH_METRICS=1 gunicorn --preload app:server, then GET /metrics
+metrics = Metrics(enabled=bool(os.environ.get('DASH_METRICS')))
+
+if metrics.enabled:
+    @server.route('/metrics')
+    def metrics_route():
+        return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 ################################################################################
 # PLOTS
 ################################################################################
-df_ = pd.read_pickle('./pred_station_date.pkl')
+# Memory-mapped columns, shared by all workers (see predstore.py), or, if MODEL_REGISTRY
+# is set, forecasts on demand from the fitted models in that folder (see predservice.py)
+with startup_step('predictions'):
+    if os.environ.get('MODEL_REGISTRY'):
+        import predservice
+        registry = predservice.ModelRegistry(os.environ['MODEL_REGISTRY'],
+                                             max_models=int(os.environ.get('MAX_MODELS', 4)))
+        pred_store = predservice.PredictionService(registry)
+        date_min, date_max = pred_store.date_range()
+        # The day after the end of training, "tomorrow"
+        date_initial = date_min
+    else:
+        pred_store = predstore.open_store('./pred_station_date.pkl', './pred_store')
+        date_min, date_max, date_initial = date(2022, 3, 1), date(2022, 3, 31), date(2022, 3, 30)
+
+
+# Daily traffic per station (a day x station frame as from daily_sums in trafficForecast.py).
+# If it is there, y_dif_mean is computed for the day shown instead of read from the pickle
+with startup_step('weekday stats'):
+    weekday_stats = {}
+    if os.path.exists('./daily_station.pkl'):
+        daily = pd.read_pickle('./daily_station.pkl')
+        weekday_stats = {stelle: WeekdayStats.from_series(daily.index, daily[stelle]) for stelle in daily.columns}
+
+
+def dif_mean(df_stelle,stelle,mydate):
+    """Prediction for mydate relative to the mean of the same weekday in the past year."""
+    row = df_stelle[df_stelle.ds == mydate]
+    if stelle in weekday_stats:
+        return weekday_stats[stelle].dif_mean(mydate, row.yhat.values[0])
+    return row.y_dif_mean.values[0]
 
 
 #### Organise labels for drop down
 
-def get_stations(filename):
-    df = pd.read_csv(filename)
+def get_stations(df):
     # list_station = 
 
     dict_list = []
@@ -54,10 +114,20 @@ def get_stations(filename):
     return dict_list
 
 
-stations = get_stations('Dauerzaehlstellen_latlon.csv')
-locations = pd.read_csv('Dauerzaehlstellen_latlon.csv')
+with startup_step('locations'):
+    locations = pd.read_csv('Dauerzaehlstellen_latlon.csv')
+    if os.environ.get('MODEL_REGISTRY'):
+        # Only the stations with a fitted model can be predicted, the map still shows all
+        stations = get_stations(locations[locations.station.isin(list(registry.index))])
+    else:
+        stations = get_stations(locations)
+    station_index = StationIndex(locations)
+
+# The map is sent once with the page, with all stations and an empty highlight trace.
+# Selecting a station only patches the highlight trace (see get_map_select)
+HIGHLIGHT_TRACE = 1
 
-def get_map_select(stelle,locations):
+def get_map_base(locations):
     
     map_ = go.Figure((go.Scattermapbox(
                         lon = locations['long'],
@@ -69,14 +139,12 @@ def get_map_select(stelle,locations):
                         marker_color=colors[1])
                         ))
     
-    if stelle:
-        select_pnt = locations[locations.station == stelle]
-        map_.add_traces((go.Scattermapbox(
-                            lon = select_pnt.long,
-                            lat = select_pnt.lat, 
-                            marker_size=20, 
-                            marker_color=colors[0],
-                            hoverinfo='text')))
+    map_.add_traces((go.Scattermapbox(
+                        lon = [],
+                        lat = [],
+                        marker_size=20,
+                        marker_color=colors[0],
+                        hoverinfo='text')))
         
     map_.update_layout(
         margin={"r":10,"t":0,"l":10,"b":0}, 
@@ -94,7 +162,24 @@ def get_map_select(stelle,locations):
     return map_
 
 
+@metrics.timed('get_map_select')
+def get_map_select(stelle,station_index):
+    """Coordinates of the highlight trace for a station, none for no station."""
+    if stelle in station_index:
+        lat, lon = station_index.position(stelle)
+        return {'lon': [lon], 'lat': [lat]}
+    return {'lon': [], 'lat': []}
+
+
+def map_patch(highlight):
+    """Update of the map figure in the browser that only replaces the highlighted station."""
+    patch = Patch()
+    patch['data'][HIGHLIGHT_TRACE]['lon'] = highlight['lon']
+    patch['data'][HIGHLIGHT_TRACE]['lat'] = highlight['lat']
+    return patch
+
 
+@metrics.timed('get_figure')
 def get_figure(traces,stelle):
        min_day = min([min(trace.x) for trace in traces])
        max_day = max([max(trace.x) for trace in traces])
@@ -119,16 +204,14 @@ def get_figure(traces,stelle):
 def shift_time_str(date_str,day_shift):
     return (pd.to_datetime(date_str) + pd.Timedelta(days=day_shift)).strftime('%Y-%m-%d')
 
-def query_data(df_,stelle,mydate):
-    df = df_[stelle].copy(deep=True)
-    # date_past = shift_time_str(mydate,-7)
-    # date_future = shift_time_str(mydate,1)
-    df = df.query(f'day_predicted == "{mydate}"')
-    return df
+@metrics.timed('query_data')
+def query_data(pred_store,stelle,mydate):
+    return pred_store.query(stelle,mydate)
     
 
-def get_traces(df_,stelle,mydate):
-    df = query_data(df_,stelle,mydate)
+@metrics.timed('get_traces')
+def get_traces(pred_store,stelle,mydate):
+    df = query_data(pred_store,stelle,mydate)
    
     traces = []
 
@@ -183,7 +266,15 @@ figure_empty = {'layout': go.Layout(
               )}
 
 
-map_empty = get_map_select(stelle=None, locations=locations)
+def to_json_ready(fig):
+    """Serializes a figure once into plain python types, so Dash only has to dump it.
+    Returns the dict and the size of its json in bytes."""
+    text = fig.to_json()
+    return json.loads(text), len(text)
+
+
+with startup_step('map'):
+    map_base, _ = to_json_ready(get_map_base(locations))
 
 def make_card(title,id_,body,style_add,image_add=None):
     style = {}
@@ -204,6 +295,7 @@ def make_card(title,id_,body,style_add,image_add=None):
 
     return card_
 
+@metrics.timed('make_indicator')
 def make_indicator(value=100):
     fig=go.Figure(go.Indicator(
         mode="delta",
@@ -224,24 +316,30 @@ def make_indicator(value=100):
 
 
 ##### GET WEATHER ######
-dwd_weather = dwdforecast.Weather("10147") # Station-ID for HH-Fuhlsbüttel
-time_tomorrow = datetime.now(timezone.utc)+timedelta(days=1)
-temperature_tomorrow = dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.TEMPERATURE, time_tomorrow)
-rain_tomorrow = dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.PRECIPITATION, time_tomorrow)
-sun_tomorrow = dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.SUN_DURATION, time_tomorrow)
-wind_tomorrow = dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.WIND_SPEED, time_tomorrow)
-
-
-string_temp = ('Temperature: ' + str(round(temperature_tomorrow - 273.51)) + ' \u00b0' + 'C')
-string_rain = ('Rainfall: ' + str(rain_tomorrow) + ' mm')
-string_sun = ('Sunshine: ' + str(round(sun_tomorrow/(60*60),1)) + ' hours')
-string_wind = ('Windspeed: ' + str(round(wind_tomorrow)) + ' m/s')
+# Refreshed in a background thread, so neither startup nor requests wait for the DWD.
+# The thread starts with the first request of each worker, not in the gunicorn master (--preload).
+# WEATHER_STUB=1 serves a fixed forecast instead, e.g. for local runs without network.
+weather_cache = weather.WeatherCache(
+    fetch=weather.fetch_stub if os.environ.get('WEATHER_STUB') else weather.fetch_dwd,
+    interval=int(os.environ.get('WEATHER_REFRESH_SECONDS', 30 * 60)))
+
+
+# The card asks for the forecast on page load and then every few seconds until there is one
+# (the background fetch may still be running right after startup), then every 10 minutes
+WEATHER_POLL_MS = 5 * 1000
+WEATHER_REFRESH_MS = 10 * 60 * 1000
+
+
+def weather_body(lines):
+    return ([html.H5(lines[0],className="text-muted",style={'margin-top': '15px'})] +
+            [html.H5(line,className="text-muted") for line in lines[1:]])
  
 
 ################################################################################
 # LAYOUT
 ################################################################################
 
+startup_layout = time.perf_counter()
 app.layout = html.Div([
 
         html.Div(id='title', children=[
@@ -265,17 +363,17 @@ app.layout = html.Div([
                     For the moment, can select a day in March 2022 for the prediction:",
                ),
             html.Div(dcc.DatePickerSingle(id='date-picker',
-        min_date_allowed=date(2022, 3, 1),
-        max_date_allowed=date(2022, 3, 31),
-        initial_visible_month=date(2022, 3, 1),
+        min_date_allowed=date_min,
+        max_date_allowed=date_max,
+        initial_visible_month=date_initial.replace(day=1),
         display_format='DD MMMM Y',
-        date=date(2022, 3, 30))),
+        date=date_initial)),
                ], width={"size": 11}, lg=2),#, "offset": 1
         dbc.Col([
         ####  Drop down and MAP #####
         make_card("1. Select the traffic hub", "map-card",style_add={'min-height': '200px'},body=[
             html.Div(id='map-parent',n_clicks=0, children=[     
-                    dcc.Graph(id='map', figure=map_empty)], style={'min-width': '100px'}),
+                    dcc.Graph(id='map', figure=map_base)], style={'min-width': '100px'}),
             html.Br(),
             html.Div(id='dropdown-parent', n_clicks=0,children=[
                 dcc.Dropdown(id='dropdown-menu',
@@ -293,10 +391,8 @@ app.layout = html.Div([
                     ]), class_name='mb-3'),
         ##### Card with weather #####
         dbc.Row(make_card("3. Check the weather tomorrow","weath_card", image_add='./assets/rainy.png', style_add={'width': '100%'},
-                  body=[html.H5(string_temp,className="text-muted",style={'margin-top': '15px'}),
-                        html.H5(string_rain,className="text-muted"),
-                        html.H5(string_sun,className="text-muted"),
-                        html.H5(string_wind,className="text-muted")
+                  body=[html.Div(id='weather-text', children=weather_body(weather.UNAVAILABLE)),
+                        dcc.Interval(id='weather-interval', n_intervals=0, interval=WEATHER_POLL_MS)
                     ]),  class_name='mb-3')
         ], width=11,lg=3), 
         ], justify="center")
@@ -326,6 +422,94 @@ app.layout = html.Div([
                    ])
                    ])
 
+################################################################################
+# OUTPUT CACHE
+################################################################################
+
+class LRUCache:
+    """Least recently used cache with a memory budget in bytes, shared by the threads of a worker."""
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size):
+        """Adds an entry and evicts the least recently used ones over the budget. An entry
+        larger than the whole budget is not kept, so maxbytes=0 turns the cache off."""
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if size > self.maxbytes:
+                return
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes and self._items:
+                self.nbytes -= self._items.popitem(last=False)[1][1]
+
+
+def render_outputs(station_num,mydate):
+    """Builds the outputs of update_from_dropdown for a station and day, the map as the
+    coordinates of its highlight trace. Returns them with the figures as json-ready dicts,
+    and their size in bytes."""
+    traces, df_stelle = get_traces(pred_store,station_num,mydate)
+    map_ = get_map_select(station_num,station_index)
+    size_map = len(json.dumps(map_))
+    name_ = station_index.alias(station_num)
+    if df_stelle.empty:
+        # No predictions of this station for the day (e.g. no model of it in the registry)
+        return (figure_empty, map_, f"No prediction for {name_} on {str(mydate)[:10]}", make_indicator(), ""), size_map
+    figure_, size_fig = to_json_ready(get_figure(traces,stelle=station_num))
+    title_ = f"Traffic prediction for {name_}"
+
+    percent_ = round(dif_mean(df_stelle,station_num,mydate)*100) + 100
+    if percent_ == 100:
+        text_indic_ = "Tomorrow, this location looks like it will have traffic similar to other\
+            equivalent weekdays in the past year."
+    elif percent_ > 100:
+        text_indic_ = "Tomorrow, this location looks like it will have higher than average\
+            traffic compared to equivalent weekdays in the past year"
+    else:
+        text_indic_ = "Tomorrow, this location looks like it will have lower than average\
+            traffic compared to equivalent weekdays in the past year"
+
+    indicator_, size_ind = to_json_ready(make_indicator(percent_))
+    metrics.observe_bytes('figure', size_fig)
+    metrics.observe_bytes('map', size_map)
+    metrics.observe_bytes('indicator', size_ind)
+    return (figure_, map_, title_, indicator_, text_indic_), size_fig + size_map + size_ind
+
+
+# There are only stations x days possible outputs, keep the recently used ones rendered
+render_cache = LRUCache(maxbytes=int(os.environ.get('FIGURE_CACHE_BYTES', 64 * 2**20)))
+
+
+def cached_outputs(station_num,mydate):
+    key = (station_num, str(mydate)[:10])
+    outputs = render_cache.get(key)
+    if outputs is None:
+        outputs, size = render_outputs(station_num, key[1])
+        render_cache.put(key, outputs, size)
+    return outputs
+
+
+outputs_empty = (figure_empty, get_map_select(None,station_index), "Select a station", make_indicator(), "")
+
+# Optionally render every station and day at startup, e.g. PRECOMPUTE_FIGURES=1 gunicorn app:server
+if os.environ.get('PRECOMPUTE_FIGURES'):
+    with startup_step('precompute'):
+        for (stelle, day) in pred_store.keys():
+            cached_outputs(stelle, day)
+
+
 ################################################################################
 # INTERACTION CALLBACKS
 ################################################################################
@@ -341,28 +525,23 @@ app.layout = html.Div([
 def update_from_dropdown(station_num,mydate):
 
     if (station_num is None):
-        return figure_empty, map_empty, "Select a station", make_indicator(),""
+        outputs = outputs_empty
     
     else:
-        traces, df_stelle = get_traces(df_,station_num,mydate)
-        figure_ = get_figure(traces,stelle=station_num)
-        map_ = get_map_select(stelle=station_num,locations=locations)
-        name_ = locations.alias[locations.station == station_num].values[0]
-        title_ = f"Traffic prediction for {name_}"
-
-        percent_ = round(df_stelle[df_stelle.ds == mydate].y_dif_mean.values[0]*100) + 100
-        if percent_ == 100:
-            text_indic_ = "Tomorrow, this location looks like it will have traffic similar to other\
-                equivalent weekdays in the past year."
-        elif percent_ > 100:
-            text_indic_ = "Tomorrow, this location looks like it will have higher than average\
-                traffic compared to equivalent weekdays in the past year"
-        else:
-            text_indic_ = "Tomorrow, this location looks like it will have lower than average\
-                traffic compared to equivalent weekdays in the past year"
-
-        indicator_ = make_indicator(percent_)
-        return figure_, map_, title_, indicator_, text_indic_
+        outputs = cached_outputs(station_num,mydate)
+
+    figure_, map_, title_, indicator_, text_indic_ = outputs
+    return figure_, map_patch(map_), title_, indicator_, text_indic_
+
+
+@app.callback([Output('weather-text', 'children'),
+               Output('weather-interval', 'interval')],
+              [Input('weather-interval', 'n_intervals')])
+
+def update_weather(n_intervals):
+    forecast = weather_cache.get()
+    interval = WEATHER_POLL_MS if forecast is None else WEATHER_REFRESH_MS
+    return weather_body(weather.weather_strings(forecast)), interval
 
 
 @app.callback(Output('dropdown-menu', 'value'),
@@ -377,10 +556,15 @@ def set_dropdown_from_map(clickData,n_clicks):
         return None
         
     else:
-        station_name = clickData['points'][0]['text']
-        station_num = locations.station[locations.alias == station_name].values[0]
+        return station_index.station_of_point(clickData['points'][0])
+
+
+startup_times['layout'] = time.perf_counter() - startup_layout
 
-        return station_num
+# One line in the (gunicorn) log per process that loads the app
+print('Startup in {:.0f} ms: '.format((time.perf_counter() - startup_begin) * 1000) +
+      ', '.join(f'{step} {seconds * 1000:.0f} ms' for step, seconds in startup_times.items()),
+      flush=True)
 
 
 # Add the server clause:
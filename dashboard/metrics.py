@@ -0,0 +1,101 @@
+"""
+Opt-in timing spans and payload size counters for the dashboard, in Prometheus text format.
+
+    metrics = Metrics(enabled=True)
+
+    @metrics.timed('get_figure')
+    def get_figure(...): ...
+
+    metrics.observe_bytes('figure', len(text))
+    metrics.render()   # text for the /metrics route
+
+When disabled, `timed` returns the function itself and `observe_bytes` returns at once,
+so the hot path is unchanged. Every gunicorn worker counts for itself; the counters
+carry its pid, so the scrapes of several workers can be told apart.
+"""
+import os
+import threading
+import time
+from functools import wraps
+
+# Upper bounds of the latency histogram buckets, in seconds
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Upper bounds of the payload size histogram buckets, in bytes
+BYTES_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6)
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their number and sum."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, metric, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{metric}_bucket{{{labels},le="{bound:g}"}} {cumulative}'
+        yield f'{metric}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{metric}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{metric}_count{{{labels}}} {self.count}'
+
+
+class Metrics:
+    """Time spent per span and sizes of serialized payloads, shared by the threads of a worker."""
+    def __init__(self, enabled=False, prefix='dashboard'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._spans = {}
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def timed(self, name):
+        """Decorator recording the duration of every call as span `name`."""
+        def decorator(func):
+            if not self.enabled:
+                return func
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._observe(self._spans, SECONDS_BUCKETS, name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def observe_bytes(self, name, nbytes):
+        """Records the size of one serialized payload, e.g. a figure."""
+        if self.enabled:
+            self._observe(self._payloads, BYTES_BUCKETS, name, nbytes)
+
+    def _observe(self, histograms, buckets, name, value):
+        with self._lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        """All histograms in the Prometheus text exposition format."""
+        pid = os.getpid()
+        lines = []
+        with self._lock:
+            for metric, kind, histograms, help_ in [
+                    (f'{self.prefix}_span_seconds', 'span', self._spans, 'Time spent in a step of a request.'),
+                    (f'{self.prefix}_payload_bytes', 'payload', self._payloads, 'Size of a serialized figure.')]:
+                lines += [f'# HELP {metric} {help_}', f'# TYPE {metric} histogram']
+                for name, histogram in sorted(histograms.items()):
+                    lines += histogram.lines(metric, f'{kind}="{name}",pid="{pid}"')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,148 @@
+"""
+Forecasts on demand from fitted Prophet models, instead of the precomputed pickle.
+
+A ModelRegistry keeps one fitted model per station on disk (<root>/<station>.json,
+serialized once with prophet.serialize) and an index of the stations and the last day
+each model was trained on. Models are loaded when first asked for and at most
+`max_models` are kept in memory, least recently used first out.
+
+PredictionService answers (station, day) with the same frame as PredictionStore.query
+in predstore.py: the model fit of the 7 days before and the prediction of the day, with
+the actual traffic and the comparison to the same weekday of the past year. Only days
+after the end of training are predicted, earlier days would be in-sample fits. Results
+are cached, so a day is only predicted once.
+
+Models are written by register_models in notebooks/trafficForecast.py. Prophet is only
+needed when the service is used.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from predstore import COLUMNS
+from weekdaystats import WeekdayStats
+
+INDEX = 'index.json'
+
+
+class ModelRegistry:
+    """Fitted models per station on disk, loaded lazily into an LRU of `max_models`."""
+    def __init__(self, root, max_models=4):
+        self.root = root
+        self.max_models = max_models
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+        path = os.path.join(root, INDEX)
+        self.index = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.index = {int(stelle): entry for stelle, entry in json.load(f).items()}
+
+    def save(self, stelle, m):
+        """Serializes a fitted model of a station and records the last day it was trained on."""
+        from prophet.serialize import model_to_json
+
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, f'{stelle}.json')
+        with open(path + '.tmp', 'w') as f:
+            f.write(model_to_json(m))
+        os.replace(path + '.tmp', path)
+
+        with self._lock:
+            self.index[int(stelle)] = {'first_day': str(m.history.ds.min().date()),
+                                       'last_day': str(m.history.ds.max().date())}
+            self._models.pop(int(stelle), None)
+            with open(os.path.join(self.root, INDEX + '.tmp'), 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            os.replace(os.path.join(self.root, INDEX + '.tmp'), os.path.join(self.root, INDEX))
+
+    def get(self, stelle):
+        """The model of a station with its WeekdayStats, or None if there is no model."""
+        if stelle not in self.index:
+            return None
+        with self._lock:
+            if stelle in self._models:
+                self._models.move_to_end(stelle)
+                return self._models[stelle]
+
+        from prophet.serialize import model_from_json
+        with open(os.path.join(self.root, f'{stelle}.json')) as f:
+            m = model_from_json(f.read())
+        entry = (m, WeekdayStats.from_series(m.history.ds, m.history.y))
+
+        with self._lock:
+            self._models[stelle] = entry
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        return entry
+
+
+class PredictionService:
+    """Predictions by (station, day) from the models of a ModelRegistry, with the
+    `cache_size` most recently asked ones kept."""
+    def __init__(self, registry, rows_outp=8, horizon=14, cache_size=1024):
+        self.registry = registry
+        self.rows_outp = rows_outp
+        self.horizon = horizon
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def keys(self):
+        """Any day can be asked for, there is no fixed set of (station, day) to precompute."""
+        return ()
+
+    def date_range(self):
+        """First and last day that can be predicted for every station: the days after the
+        end of training of every model, up to `horizon` days after the end of the first.
+        Days the models were trained on would be in-sample fits, not predictions."""
+        if not self.registry.index:
+            raise ValueError(f'There are no models in the registry at {self.registry.root}')
+        first = max(pd.Timestamp(e['last_day']) for e in self.registry.index.values()) + pd.Timedelta(days=1)
+        last = min(pd.Timestamp(e['last_day']) for e in self.registry.index.values()) + pd.Timedelta(days=self.horizon)
+        if last < first:
+            raise ValueError(f'The models in {self.registry.root} end training more than {self.horizon} days apart, '
+                             'there is no day all of them can predict')
+        return first.date(), last.date()
+
+    def query(self, stelle, mydate):
+        """Predictions of a station for a day ('YYYY-MM-DD', possibly followed by a time),
+        an empty frame if the station has no model."""
+        key = (stelle, str(mydate)[:10])
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        df = self.predict(*key)
+        with self._lock:
+            self._cache[key] = df
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return df
+
+    def predict(self, stelle, day):
+        """Predictions of a station for a day after the end of its training, an empty frame
+        if there is no model or the day is not after the end of training."""
+        day = pd.Timestamp(day)
+        entry = self.registry.get(stelle)
+        if entry is None or day <= entry[0].history.ds.max():
+            df = pd.DataFrame({col: pd.Series(dtype='datetime64[ns]' if col in ('ds', 'day_predicted') else 'float64')
+                               for col in COLUMNS})
+            df['Zählstelle'] = stelle
+            return df
+        m, weekday_stats = entry
+
+        df = m.predict(pd.DataFrame({'ds': pd.date_range(end=day, periods=self.rows_outp, freq='D')}))
+        df = df[['ds', 'yhat_lower', 'yhat_upper', 'yhat']]
+        ### Actual traffic where the model has it, none for the predicted day as in the pickle
+        df['y'] = df.ds.map(m.history.set_index('ds').y)
+        df.loc[df.index[-1], 'y'] = float('nan')
+        df['y_dif_mean'] = float('nan')
+        df.loc[df.index[-1], 'y_dif_mean'] = weekday_stats.dif_mean(day, df.yhat.iloc[-1], last=m.history.ds.max())
+        df['day_predicted'] = day
+        df['Zählstelle'] = stelle
+        return df
@@ -0,0 +1,128 @@
+"""
+Compact, memory-mapped store of the dashboard predictions.
+
+pred_station_date.pkl is converted once into one .npy file per column, sorted by
+station and day_predicted, plus the row ranges of every (station, day). The columns
+are opened read-only with mmap, so the pages are shared through the OS page cache by
+all worker processes instead of every worker holding its own copy of the frames.
+
+store_dir is a symlink to the current version of the store, a directory next to it.
+A rebuild writes a new version and then replaces the symlink, so a reader always opens
+a complete store. Builds are serialised with a lock file, so workers started at the
+same time (without --preload) build the store only once.
+"""
+import fcntl
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['ds', 'yhat_lower', 'yhat_upper', 'yhat', 'y', 'y_dif_mean', 'day_predicted']
+INDEX = ['station', 'day', 'start', 'stop']
+
+
+@contextmanager
+def _build_lock(store_dir):
+    """Held by at most one process at a time (an flock on store_dir.lock)."""
+    with open(f'{store_dir}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_stale(pkl_path, store_dir):
+    stamp = os.path.join(store_dir, 'stop.npy')
+    return not os.path.exists(stamp) or os.path.getmtime(stamp) < os.path.getmtime(pkl_path)
+
+
+def build(pkl_path, store_dir):
+    """Converts the pickled {station: predictions} into the store at store_dir."""
+    with _build_lock(store_dir):
+        _build(pkl_path, store_dir)
+
+
+def _build(pkl_path, store_dir):
+    df_ = pd.read_pickle(pkl_path)
+    df = pd.concat([df.assign(Zählstelle=stelle) for stelle, df in df_.items()], ignore_index=True)
+    df = df.sort_values(['Zählstelle', 'day_predicted'], kind='stable', ignore_index=True)
+
+    # Row range of every (station, day_predicted)
+    keys = df[['Zählstelle', 'day_predicted']]
+    starts = np.flatnonzero((keys != keys.shift()).any(axis=1).to_numpy())
+    stops = np.r_[starts[1:], len(df)]
+
+    # A new version next to store_dir, which the symlink points to once it is complete
+    store_dir = os.path.abspath(store_dir)
+    version = f'{store_dir}.{time.time_ns()}'
+    os.makedirs(version)
+    for col in COLUMNS:
+        np.save(os.path.join(version, f'{col}.npy'), df[col].to_numpy())
+    np.save(os.path.join(version, 'station.npy'), df['Zählstelle'].to_numpy(dtype='int64')[starts])
+    np.save(os.path.join(version, 'day.npy'), df['day_predicted'].to_numpy(dtype='datetime64[D]')[starts])
+    np.save(os.path.join(version, 'start.npy'), starts)
+    np.save(os.path.join(version, 'stop.npy'), stops)
+
+    # A store of an older version of this module is a plain directory, which a symlink
+    # cannot replace. It is removed once, readers of it keep their open mmaps
+    if os.path.isdir(store_dir) and not os.path.islink(store_dir):
+        shutil.rmtree(store_dir)
+    link = f'{version}.link'
+    os.symlink(os.path.basename(version), link)
+    previous = os.path.realpath(store_dir) if os.path.islink(store_dir) else None
+    os.replace(link, store_dir)
+
+    # Keep the version just replaced for readers that resolved the link before the swap
+    keep = {os.path.realpath(version), previous}
+    parent, name = os.path.split(store_dir)
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (entry.startswith(name + '.') and entry[len(name) + 1:].isdigit()
+                and os.path.realpath(path) not in keep):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def open_store(pkl_path, store_dir):
+    """Opens the store, (re)building it first if it is missing or older than the pickle."""
+    if _is_stale(pkl_path, store_dir):
+        with _build_lock(store_dir):
+            # Another process may have built it while this one waited for the lock
+            if _is_stale(pkl_path, store_dir):
+                _build(pkl_path, store_dir)
+    return PredictionStore(store_dir)
+
+
+class PredictionStore:
+    """Predictions by (station, day_predicted), read from the memory-mapped columns."""
+    def __init__(self, store_dir):
+        # All columns of one version. If two rebuilds removed it while it was being
+        # opened, the current one is opened instead
+        for attempt in range(3):
+            try:
+                self._open(os.path.realpath(store_dir))
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def _open(self, version):
+        self.columns = {col: np.load(os.path.join(version, f'{col}.npy'), mmap_mode='r')
+                        for col in COLUMNS}
+        station, day, start, stop = (np.load(os.path.join(version, f'{name}.npy')) for name in INDEX)
+        self.index = {(int(s), str(d)): (int(a), int(b)) for s, d, a, b in zip(station, day, start, stop)}
+
+    def keys(self):
+        return self.index.keys()
+
+    def query(self, stelle, mydate):
+        """Predictions of a station made for a day ('YYYY-MM-DD', possibly followed by a
+        time), an empty frame if there are none. The columns are views of the mmaps
+        (read-only), not copies."""
+        start, stop = self.index.get((stelle, str(mydate)[:10]), (0, 0))
+        df = pd.DataFrame({col: values[start:stop] for col, values in self.columns.items()}, copy=False)
+        df['Zählstelle'] = stelle
+        return df
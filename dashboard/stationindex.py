@@ -0,0 +1,61 @@
+"""
+Lookups of the counting stations for the map callbacks.
+
+StationIndex is built once from Dauerzaehlstellen_latlon.csv. It answers station number
+-> alias and position, map alias -> station number and the station of a point clicked on
+the map with dicts, and the nearest station to any coordinate with one vectorized
+distance computation over all stations, so none of the callbacks scans the locations
+dataframe.
+"""
+import numpy as np
+
+# Degrees of latitude per kilometre, longitude is scaled by the cosine of the latitude
+KM_PER_DEGREE = 111.2
+
+
+class StationIndex:
+    """Station number, alias and coordinates of every station of `locations` (a dataframe
+    with the columns station, alias, lat and long), indexed both ways."""
+    def __init__(self, locations):
+        self.stations = locations.station.to_numpy()
+        self.aliases = locations.alias.to_numpy()
+        self.lat = locations.lat.to_numpy(dtype=float)
+        self.lon = locations.long.to_numpy(dtype=float)
+        self._by_station = {int(station): i for i, station in enumerate(self.stations)}
+        self._by_alias = {alias: int(station) for alias, station in zip(self.aliases, self.stations)}
+        # Plane coordinates in km around the mean latitude, good enough within a city
+        self._scale = np.cos(np.radians(self.lat.mean())) if len(self.lat) else 1.0
+        self._xy = np.column_stack([self.lon * self._scale, self.lat]) * KM_PER_DEGREE
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __contains__(self, station):
+        return station in self._by_station
+
+    def alias(self, station):
+        return self.aliases[self._by_station[station]]
+
+    def position(self, station):
+        """Latitude and longitude of a station."""
+        i = self._by_station[station]
+        return self.lat[i], self.lon[i]
+
+    def station_of_alias(self, alias):
+        """Station number of a map label, None if there is no such station."""
+        return self._by_alias.get(alias)
+
+    def nearest(self, lat, lon, k=1):
+        """Station numbers of the k stations nearest to (lat, lon) and their distances in km,
+        nearest first."""
+        d = np.hypot(*(self._xy - np.array([lon * self._scale, lat]) * KM_PER_DEGREE).T)
+        order = np.argsort(d, kind='stable')[:k]
+        return [int(s) for s in self.stations[order]], d[order]
+
+    def station_of_point(self, point):
+        """Station of a point of the map's clickData: by its label, or by its position if
+        the label is unknown (e.g. the locations changed since the page was loaded)."""
+        station = self.station_of_alias(point.get('text'))
+        if station is None and 'lat' in point and 'lon' in point and len(self):
+            station = self.nearest(point['lat'], point['lon'])[0][0]
+        return station
@@ -0,0 +1,106 @@
+"""
+Tomorrow's weather forecast for the dashboard, refreshed in the background.
+
+A WeatherCache calls a fetch function on a schedule in a daemon thread and keeps the
+last good result for `ttl` seconds, so requests never wait for the DWD service. The
+fetch function can be replaced by a stub (e.g. WEATHER_STUB=1 in app.py) for local runs
+and tests without network.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+UNAVAILABLE = ["Forecast currently unavailable"]
+
+
+def fetch_dwd(station_id="10147"):
+    """Fetches tomorrow's forecast from the DWD, default station HH-Fuhlsbüttel."""
+    from simple_dwd_weatherforecast import dwdforecast
+
+    dwd_weather = dwdforecast.Weather(station_id)
+    time_tomorrow = datetime.now(timezone.utc) + timedelta(days=1)
+    return {
+        'temperature': dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.TEMPERATURE, time_tomorrow),
+        'rain': dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.PRECIPITATION, time_tomorrow),
+        'sun': dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.SUN_DURATION, time_tomorrow),
+        'wind': dwd_weather.get_forecast_data(dwdforecast.WeatherDataType.WIND_SPEED, time_tomorrow),
+    }
+
+
+def fetch_stub():
+    """Fixed forecast in the format of fetch_dwd, used instead of the DWD service."""
+    return {'temperature': 285.65, 'rain': 0.4, 'sun': 5 * 60 * 60, 'wind': 4.2}
+
+
+def weather_strings(forecast):
+    """Lines of the weather card for a forecast from fetch_dwd, or a notice if there is none."""
+    if forecast is None:
+        return UNAVAILABLE
+    try:
+        return [('Temperature: ' + str(round(forecast['temperature'] - 273.51)) + ' °' + 'C'),
+                ('Rainfall: ' + str(forecast['rain']) + ' mm'),
+                ('Sunshine: ' + str(round(forecast['sun']/(60*60),1)) + ' hours'),
+                ('Windspeed: ' + str(round(forecast['wind'])) + ' m/s')]
+    except (KeyError, TypeError):
+        # The DWD leaves values empty at times
+        return UNAVAILABLE
+
+
+class WeatherCache:
+    """Forecast refreshed every `interval` seconds in a background thread, or after `retry`
+    seconds if fetching failed. get() returns the last forecast that is at most `ttl`
+    seconds old, or None."""
+    def __init__(self, fetch, interval=30 * 60, ttl=6 * 60 * 60, retry=60):
+        self.fetch = fetch
+        self.interval = interval
+        self.retry = retry
+        self.ttl = ttl
+        self._forecast = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        os.register_at_fork(after_in_child=self._reinit_after_fork)
+
+    def _reinit_after_fork(self):
+        ### The refresh thread may have held the lock when the process forked
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Fetches once. Failures are logged and keep the last good forecast."""
+        try:
+            forecast = self.fetch()
+        except Exception:
+            logger.exception("Weather forecast could not be fetched")
+            return False
+        with self._lock:
+            self._forecast = forecast
+            self._fetched_at = time.monotonic()
+        return True
+
+    def _run(self):
+        while True:
+            ok = self.refresh()
+            time.sleep(self.interval if ok else min(self.retry, self.interval))
+
+    def start(self):
+        """Starts the refresh thread, once per process: after a fork (gunicorn workers)
+        the thread of the parent does not exist in the child. get() calls it, so the
+        thread only runs in processes that serve requests."""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="weather-refresh", daemon=True)
+            self._thread.start()
+
+    def get(self):
+        self.start()
+        with self._lock:
+            if self._fetched_at is None or time.monotonic() - self._fetched_at > self.ttl:
+                return None
+            return self._forecast
@@ -0,0 +1,75 @@
+"""
+Same-weekday statistics of the daily traffic over a trailing window.
+
+WeekdayStats keeps the cumulative sum, sum of squares and count of the daily values of
+every weekday up to every day, so the mean, std and count of one weekday over the
+`window` days before any day is a difference of two rows: O(1) per query, and O(1)
+(amortised) per added day. It answers the "vs. same weekday last year" comparison of
+get_dif_mean_pred in notebooks/trafficForecast.py and of the dashboard indicator.
+"""
+import numpy as np
+import pandas as pd
+
+
+class WeekdayStats:
+    """Mean, std and count of the values of each weekday over the last `window` days
+    before a day. Days are added in order; missing days and NaN values are skipped."""
+    def __init__(self, first_day, window=365):
+        self.first_day = pd.Timestamp(first_day).normalize()
+        self.window = window
+        self.n_days = 0
+        # Row i: sum, sum of squares and count per weekday of the days before day i
+        self._cum = np.zeros((64, 3, 7))
+
+    @classmethod
+    def from_series(cls, ds, y, window=365):
+        """Builds the statistics of daily values y on days ds at once."""
+        ds = pd.DatetimeIndex(ds).normalize()
+        y = np.asarray(y, dtype='float64')
+        stats = cls(ds.min(), window)
+        pos = (ds - stats.first_day).days.to_numpy()
+        stats.n_days = pos.max() + 1
+
+        valid = ~np.isnan(y)
+        daily = np.zeros((stats.n_days + 1, 3, 7))
+        wd = ds.weekday.to_numpy()[valid]
+        daily[pos[valid] + 1, 0, wd] = y[valid]
+        daily[pos[valid] + 1, 1, wd] = y[valid] ** 2
+        daily[pos[valid] + 1, 2, wd] = 1
+        stats._cum = np.cumsum(daily, axis=0)
+        return stats
+
+    def _position(self, day):
+        return (pd.Timestamp(day).normalize() - self.first_day).days
+
+    def add(self, day, value):
+        """Adds the value of the day after the last added one (or of a later day, the days
+        in between count as missing)."""
+        pos = self._position(day)
+        if pos < self.n_days:
+            raise ValueError(f"Days must be added in order, {day} is before the last added day")
+        if pos + 2 > len(self._cum):
+            self._cum = np.concatenate([self._cum, np.zeros((max(len(self._cum), pos + 2), 3, 7))])
+        self._cum[self.n_days + 1:pos + 2] = self._cum[self.n_days]
+        if not np.isnan(value):
+            self._cum[pos + 1, :, pd.Timestamp(day).weekday()] += (value, value * value, 1)
+        self.n_days = pos + 1
+
+    def stats(self, day, last=None):
+        """Mean, std and count of the weekday of `day` over the `window` days ending with
+        `last` (default: the day before `day`)."""
+        end = self._position(day) if last is None else self._position(last) + 1
+        end = min(max(end, 0), self.n_days)
+        start = max(end - self.window, 0)
+        wd = pd.Timestamp(day).weekday()
+        total, squares, count = self._cum[end, :, wd] - self._cum[start, :, wd]
+        if count == 0:
+            return np.nan, np.nan, 0
+        mean = total / count
+        std = np.sqrt(max(squares - total * mean, 0) / (count - 1)) if count > 1 else np.nan
+        return mean, std, int(count)
+
+    def dif_mean(self, day, y_hat, last=None):
+        """Difference of y_hat to the mean of the same weekday, relative to that mean."""
+        mean = self.stats(day, last)[0]
+        return (y_hat - mean) / mean
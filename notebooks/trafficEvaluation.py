@@ -0,0 +1,119 @@
+'''
+Evaluation of the Prophet models and the copy baseline of all stations on one fold plan.
+
+Replaces the per-station cross_validation / performance_metrics cells of notebook 05 and
+baseline_00.csv: every station is evaluated on the same cutoffs, and the errors of both
+models are summarised in one table per station and horizon (days after the cutoff):
+
+    series = {zähl: tf.daily_frame(df_y, df_missing, zähl) for zähl in stations}
+    cutoffs = fold_plan(series, horizon=30)
+    df_report, df_pred = evaluate(series, df_params, cutoffs, 30, "../data/eval_cache",
+                                  outfile="../data/evaluation.csv")
+
+Model folds are cached like those of search_hyperparameters in trafficModules, under a
+key that includes a hash of the data the fold uses (the station's days up to the end of
+its test window). Changing the parameters of one station, or adding new days, therefore
+only recomputes the folds that change.
+'''
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+import trafficModules as tm
+
+MODELS = ['prophet', 'baseline']
+
+
+def fold_plan(series, horizon, period=30, n_folds=4, initial=365):
+    '''
+    Cutoffs shared by all stations: the last `n_folds` cutoffs, `period` days apart, such
+    that every station has `initial` days of training before the first and a complete
+    test window of `horizon` days after the last.
+    '''
+    start = max(y.ds.min() for y in series.values()) + pd.Timedelta(days=initial)
+    end = min(y.ds.max() for y in series.values()) - pd.Timedelta(days=horizon)
+    if end < start:
+        raise ValueError('The series of the stations do not overlap enough for a single fold')
+    cutoffs = pd.date_range(end=end, periods=n_folds, freq=f'{period}D')
+    return cutoffs[cutoffs >= start]
+
+
+def fold_hashes(y, cutoffs, horizon):
+    '''
+    Content hash of the data every fold uses: the days of y up to cutoff + horizon.
+    Hashes every row once and every fold hashes the row hashes up to its end.
+    '''
+    y = y.sort_values('ds')
+    rows = pd.util.hash_pandas_object(y[['ds', 'y']], index=False).to_numpy()
+    ends = y.ds.searchsorted(pd.DatetimeIndex(cutoffs) + pd.Timedelta(days=horizon), side='right')
+    return [hashlib.sha1(rows[:end].tobytes()).hexdigest()[:16] for end in ends]
+
+
+def baseline_folds(y, cutoffs, horizon):
+    '''
+    Predictions of the copy baseline (CopyRegressor) for every fold, from the series
+    interpolated as in notebook 05, scored against the days with a known y.
+    '''
+    y = y.sort_values('ds', ignore_index=True)
+    y_int = tm.InterpolateImputer().transform(y)
+    positions = y_int.ds.searchsorted(pd.DatetimeIndex(cutoffs), side='right')
+    _, y_pred = tm.copy_weekdays(y_int.y.to_numpy(dtype=float), positions, horizon)
+
+    idx = positions[:, None] + np.arange(horizon)[None, :]
+    df = pd.DataFrame({'ds': y_int.ds.to_numpy()[idx].ravel(),
+                       'yhat': y_pred.ravel(),
+                       'cutoff': np.repeat(pd.DatetimeIndex(cutoffs), horizon)})
+    df['y'] = df.ds.map(y.set_index('ds').y)
+    return df.dropna(subset=['y'])
+
+
+def evaluate(series, df_params, cutoffs, horizon, cache_dir, country_hol='DE', workers=None, outfile=None):
+    '''
+    Evaluates Prophet, with the parameters of every station in df_params (as found by
+    search_hyperparameters), and the copy baseline on the same cutoffs for every station
+    of `series` ({Zählstelle: daily dataframe with ds and y}).
+    Missing model folds run in a process pool with `workers` processes (workers=1 runs
+    them in this process) and are cached in cache_dir.
+    Returns the report, one row per station and horizon with RMSE and MAPE of both models
+    (written to outfile as csv if given), and the predictions of every fold.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    cutoffs = pd.DatetimeIndex(cutoffs)
+
+    folds = {}
+    for station, y in series.items():
+        params = df_params.loc[df_params.Zählstelle == station, tm.PARAM_COLUMNS].to_dict(orient='records')[0]
+        for cutoff, hash_ in zip(cutoffs, fold_hashes(y, cutoffs, horizon)):
+            folds[(station, cutoff)] = (params, tm.fold_path(cache_dir, station, params, cutoff, horizon,
+                                                             country_hol, hash_))
+    tasks = [(station, params, cutoff, horizon, country_hol, path)
+             for (station, cutoff), (params, path) in folds.items() if not os.path.exists(path)]
+    print(f'{len(folds)} folds of {len(series)} stations, {len(tasks)} not cached')
+
+    ### The folds are those of the hyperparameter search, and share its cache
+    tm.run_folds(series, tasks, workers)
+
+    preds = []
+    for station, y in series.items():
+        df_model = pd.concat([pd.read_pickle(folds[(station, cutoff)][1]) for cutoff in cutoffs])
+        for model, df in [('prophet', df_model), ('baseline', baseline_folds(y, cutoffs, horizon))]:
+            preds.append(df[['cutoff', 'ds', 'y', 'yhat']].assign(Zählstelle=station, model=model))
+    df_pred = pd.concat(preds, ignore_index=True)
+    df_pred['horizon'] = (df_pred.ds - df_pred.cutoff).dt.days
+    df_pred = df_pred[['Zählstelle', 'model', 'cutoff', 'ds', 'horizon', 'y', 'yhat']]
+
+    ### Same definitions as sklearn's mean_squared_error(squared=False) and mean_absolute_percentage_error
+    errors = df_pred.assign(se=(df_pred.y - df_pred.yhat) ** 2,
+                            ape=(df_pred.y - df_pred.yhat).abs() / df_pred.y.abs().clip(lower=np.finfo(float).eps))
+    df_report = errors.groupby(['Zählstelle', 'horizon', 'model']).agg(RMSE=('se', 'mean'), MAPE=('ape', 'mean'))
+    df_report['RMSE'] = np.sqrt(df_report['RMSE'])
+    df_report = df_report.unstack('model')
+    df_report.columns = [f'{metric}_{model}' for metric, model in df_report.columns]
+    df_report = df_report[[f'{metric}_{model}' for metric in ['RMSE', 'MAPE'] for model in MODELS]].reset_index()
+
+    if outfile is not None:
+        df_report.to_csv(outfile, index=False)
+
+    return df_report, df_pred
@@ -0,0 +1,449 @@
+'''
+Next-day forecasts for many stations and cutoffs, as in notebook 06, run in a process pool.
+
+The modelling functions are those of notebook 06, moved here so worker processes can
+import them. "forecast_grid" fits one Prophet model per (station, cutoff) pair and
+gathers the results into the {Zählstelle: df_pred} structure of pred_station_date.pkl:
+
+    preds = forecast_grid(df, df_params, cv_cutoffs, workers=8)
+    pd.to_pickle(preds, "../data/pred_station_date.pkl")
+'''
+import importlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from prophet import Prophet
+
+import trafficModules as tm
+
+### The weekday statistics and the model registry are shared with the dashboard, which is
+### deployed on its own. Its folder is appended to the import path only by the functions
+### that need them, so its modules never shadow others
+DASHBOARD_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dashboard')
+
+
+def _dashboard_module(name):
+    if DASHBOARD_DIR not in sys.path:
+        sys.path.append(DASHBOARD_DIR)
+    return importlib.import_module(name)
+
+### Columns of the prediction dataframes stored for the dashboard
+PRED_COLUMNS = ["ds", "yhat_lower", "yhat_upper", "yhat", "y", "y_dif_mean", "day_predicted", "Zählstelle"]
+
+
+### Function to get daily sums for each station
+def daily_sum_station(df, zähl): ### zähl
+
+    zähl = str(zähl) # Query needs zähl as a string
+
+    ### Filter for one single zählstelle
+    # Set datetime as column, insert rows, where the time is missing in timeseries as y = NaN
+    df = df.query(f'Zählstelle == {zähl}').asfreq(freq="H").reset_index()
+
+    ##Drop unused columns
+    df.drop(['Zählstelle','PKW','LKW'],axis=1, inplace=True)
+
+    ## Rename columns for Prophet
+    df.rename(columns={'Gesamt': 'y', 'datetime': 'ds'}, inplace=True)
+    ## Hourly counts are uint16 in the compact schema, the daily sums need more
+    df['y'] = df['y'].astype('float64')
+
+    ### Which hours have NaNs?
+    df['NaN'] = df['y'].isna()
+
+    ### Set the index again to 'ds' and make daily sums of traffic and hourly NaNs
+    df_daily = df.set_index('ds').resample('d').sum()
+
+    ### If a day has more than 2 hourly NaNs, replace the day with nan
+    df_daily.loc[df_daily['NaN'] > 2,f'y'] = np.nan
+    df_daily.drop(f'NaN', axis=1,inplace=True)
+
+    ## Overwrite dataframe of all zählstellen with chosen zählstelle in daily sums
+    df = df_daily.reset_index()
+
+    return df
+
+
+### Function to get the daily sums of all stations at once, computed as in daily_sum_station
+def daily_sums(df, stations=None, max_missing=2, interpolate=False, block=2**18):
+    '''
+    Daily sums of 'Gesamt' for every station of the hourly dataframe df (or of `stations`)
+    in one pass over the data, without a copy per station. As in daily_sum_station, hours
+    missing between the first and last hour of a station count as NaN, and days with more
+    than `max_missing` NaN hours are NaN.
+    Returns two day x station dataframes: the daily sums and the number of missing hours
+    per day. Days outside the first and last hour of a station are NaN in both.
+    With interpolate=True, the NaN days are interpolated in time and rounded per station,
+    as InterpolateImputer does. Rows are read `block` at a time to bound the memory used.
+    '''
+    zähl = df['Zählstelle'].to_numpy()
+    uniques = _stations(zähl, stations, block)
+    day0 = df.index.min().normalize().to_datetime64().astype('datetime64[h]')
+    n_days = (df.index.max().to_datetime64().astype('datetime64[h]') - day0).astype('int64') // 24 + 1
+
+    ### Per (station, day) cell: sum and number of hours with a count. Rows of other stations
+    ### go to an extra station len(uniques), dropped at the end
+    n_cells = (len(uniques) + 1) * n_days
+    sums = np.zeros(n_cells)
+    counted = np.zeros(n_cells)
+    ### First and last hour of every station
+    first = np.full(len(uniques) + 1, n_days * 24)
+    last = np.full(len(uniques) + 1, -1)
+    for start in range(0, len(df), block):
+        rows = slice(start, start + block)
+        hour = (df.index[rows].to_numpy(dtype='datetime64[h]') - day0).astype('int64')
+        gesamt = df['Gesamt'].iloc[rows].to_numpy(dtype='float64', na_value=np.nan)
+
+        codes = np.searchsorted(uniques, zähl[rows])
+        codes[np.append(uniques, -1)[codes] != zähl[rows]] = len(uniques)
+        cell = codes * n_days + hour // 24
+        present = ~np.isnan(gesamt)
+        counted += np.bincount(cell, weights=present, minlength=n_cells)
+        sums += np.bincount(cell, weights=np.where(present, gesamt, 0), minlength=n_cells)
+        np.minimum.at(first, codes, hour)
+        np.maximum.at(last, codes, hour)
+
+    ### Hours of every day between the first and last hour of each station, as asfreq("H") makes them
+    day_start = np.arange(n_days) * 24
+    expected = (np.minimum(day_start + 24, last[:-1, None] + 1) - np.maximum(day_start, first[:-1, None])).clip(0)
+    sums = sums[:-n_days]
+    counted = counted[:-n_days]
+
+    missing = np.where(expected > 0, expected - counted.reshape(expected.shape), np.nan)
+    sums = np.where(missing <= max_missing, sums.reshape(expected.shape), np.nan)
+
+    index = pd.date_range(day0, periods=n_days, freq='D', name='ds')
+    columns = pd.Index(uniques, name='Zählstelle')
+    df_y = pd.DataFrame(sums.T, index=index, columns=columns)
+    df_missing = pd.DataFrame(missing.T, index=index, columns=columns)
+
+    if interpolate:
+        df_y = df_y.interpolate(method='time', limit_direction='both').round().where(df_missing.notna())
+
+    return df_y, df_missing
+
+
+### Sorted station numbers of df (of `stations` only, if given), found block by block
+### since pd.unique allocates a hash table as long as its input
+def _stations(zähl, stations, block):
+    uniques = np.unique(np.concatenate([pd.unique(zähl[start:start + block]) for start in range(0, len(zähl), block)]))
+    if stations is not None:
+        uniques = np.intersect1d(uniques, stations)
+    return uniques
+
+
+### Function to get one station out of daily_sums in the format of daily_sum_station
+def daily_frame(df_y, df_missing, zähl):
+    inside = df_missing[zähl].notna()
+    return df_y.loc[inside, zähl].rename('y').reset_index()
+
+
+### Function to get the hourly counts of all stations as one matrix, for the hourly mode
+def hourly_values(df, stations=None, block=2**18):
+    '''
+    Hourly 'Gesamt' of every station of the hourly dataframe df (or of `stations`) as an
+    hour x station dataframe of float32 on a regular hourly index (the half hours of df),
+    NaN where an hour is missing. 16 stations x 11 years take 6 MB.
+    '''
+    zähl = df['Zählstelle'].to_numpy()
+    uniques = _stations(zähl, stations, block)
+    start = df.index.min()
+    n_hours = (df.index.max() - start) // pd.Timedelta(hours=1) + 1
+
+    values = np.full((n_hours, len(uniques)), np.nan, dtype='float32')
+    for first in range(0, len(df), block):
+        rows = slice(first, first + block)
+        codes = np.searchsorted(uniques, zähl[rows])
+        keep = np.append(uniques, -1)[codes] == zähl[rows]
+        hour = (df.index[rows] - start) // pd.Timedelta(hours=1)
+        gesamt = df['Gesamt'].iloc[rows].to_numpy(dtype='float32', na_value=np.nan)
+        values[np.asarray(hour)[keep], codes[keep]] = gesamt[keep]
+
+    index = pd.date_range(start, periods=n_hours, freq='h', name='ds')
+    return pd.DataFrame(values, index=index, columns=pd.Index(uniques, name='Zählstelle'))
+
+
+### Function for the hourly model of one station: Prophet with a daily seasonality on the last weeks
+def model_station_hours(params, df_hours, zähl, cutoff_train, horizon=24, history_days=8 * 7, country_hol="DE"):
+    '''
+    Fits Prophet with params and a daily seasonality to the hours of station zähl in
+    df_hours (see hourly_values) of the `history_days` days up to and including the day
+    cutoff_train, and predicts the `horizon` hours after it. Training on a trailing window
+    keeps an hourly fit about as large as a daily one over all years.
+    Returns the model and ds, yhat_lower, yhat_upper, yhat and y of the predicted hours.
+    '''
+    end = df_hours.index.searchsorted(pd.Timestamp(cutoff_train).normalize() + pd.Timedelta(days=1))
+    start = max(end - history_days * 24, 0)
+    values = df_hours[zähl].to_numpy(dtype='float64')
+    y_train = pd.DataFrame({'ds': df_hours.index[start:end], 'y': values[start:end]})
+
+    m = Prophet(**params, daily_seasonality=True)
+    m.add_country_holidays(country_name=country_hol)
+    with tm.suppress_stdout_stderr():
+        m.fit(y_train)
+
+    future = pd.DataFrame({'ds': pd.date_range(df_hours.index[end - 1], periods=horizon + 1, freq='h')[1:]})
+    df_pred = m.predict(future)[['ds', 'yhat_lower', 'yhat_upper', 'yhat']]
+    y_test = values[end:end + horizon]
+    df_pred['y'] = np.r_[y_test, np.full(horizon - len(y_test), np.nan)]
+    return m, df_pred
+
+
+### Define Function for time-train test split
+def time_split(df, cutoff_1):
+    # Copy the data for splitting
+    y = df.copy(deep=True)
+
+    #Make first test/train cutoff. Test is not used for cross-validation
+    y_train = y[y.ds <= cutoff_1]
+    y_test = y[y.ds > cutoff_1]
+
+    return y_train, y_test
+
+
+### Define Function to get hyperparameter values for this station as found by grid search
+def get_params_zst(df_params, zähl):
+    ### Index by Zählstelle and the 4 columns defining the hyperparameters
+    row_params = df_params.loc[df_params.Zählstelle== zähl, ['changepoint_prior_scale', 'seasonality_prior_scale',
+       'holidays_prior_scale', 'seasonality_mode']]
+    ### transform into dictionary
+    params = row_params.to_dict(orient="records")[0]
+    return params
+
+
+### Function for getting the difference from the mean in percentage of the mean
+def get_dif_mean_pred(y_train, day_pred, y_hat_):
+    day_pred_wd = day_pred.weekday() # Get weekday of day to predict
+    y_year = y_train[-365:] # Shorten y_train to the last year
+    y_wd = y_year.y[y_year.ds.dt.weekday == day_pred_wd] # get only weekdays of day to predict from last year
+    mean_y = y_wd.mean() # mean of these weekdays fro last year
+
+    return (y_hat_ - mean_y) / mean_y # Relate difference between predicted value and mean of weekday related to mean
+
+
+### Function for the actual modelling for one station and one day and prediction in Loop.
+### init: parameters of an earlier fit to start the optimisation from (see warm_start_params)
+### weekday_stats: WeekdayStats of df_st, to get y_dif_mean without slicing y_train
+def model_station_day(params, df_st, cutoff_train, day_pred, rows_outp, country_hol, init=None,
+                      weekday_stats=None):
+    ### Apply time train-test-split. Y_train ends today, cutoff_train is tomorrow
+    y_train, y_test = time_split(df_st, cutoff_train)
+
+    ### Build model
+    m = Prophet(**params, daily_seasonality=False)
+    ### Add Country holidays
+    m.add_country_holidays(country_name=country_hol)
+    ### Fit model with values until yesterday, starting from init if given
+    fit_kwargs = {} if init is None else {'init': init}
+    with tm.suppress_stdout_stderr():
+        m.fit(y_train, **fit_kwargs)
+
+    ### Construct future df (One row only - next day). This gives the dates only
+    df_pred = m.make_future_dataframe(periods = 1)
+    ### Predict: get y hat values
+    df_pred = m.predict(df_pred)
+
+    ### Column for identifying the day for which the model predicted
+    df_pred["day_predicted"] = day_pred
+    ### add true y_values to df_pred
+    y_val = y_train.y.tolist()
+    y_val.append(np.nan)
+    df_pred["y"] = y_val
+    ### Shorten as output for dashboard
+    df_pred = df_pred.tail(rows_outp)
+    df_pred.reset_index(inplace = True)
+
+    ### Add difference of prediction to mean traffic of this weekday
+    y_hat_ = df_pred.yhat.iloc[-1]
+    y_dif_mean_lst = [np.nan]*(rows_outp-1)
+    if weekday_stats is None:
+        y_dif_mean = get_dif_mean_pred(y_train, day_pred, y_hat_)
+    else:
+        y_dif_mean = weekday_stats.dif_mean(day_pred, y_hat_, last=cutoff_train)
+    y_dif_mean_lst.append(y_dif_mean)
+    df_pred["y_dif_mean"] = y_dif_mean_lst
+
+    ### Return Model and DataFrame of Predictions
+    return m, df_pred
+
+
+### Function to get the fitted parameters of a model as starting point for the next fit,
+### as in the Prophet documentation on updating fitted models
+def warm_start_params(m):
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        if m.mcmc_samples == 0:
+            res[pname] = m.params[pname][0][0]
+        else:
+            res[pname] = np.mean(m.params[pname])
+    for pname in ['delta', 'beta']:
+        if m.mcmc_samples == 0:
+            res[pname] = m.params[pname][0]
+        else:
+            res[pname] = np.mean(m.params[pname], axis=0)
+    return res
+
+
+### Function for rolling daily forecasts of one station, warm starting every fit from the previous one
+def rolling_forecast(params, df_st, cv_cutoffs, country_hol="DE", rows_outp=8, refit_every=None,
+                     compare_cold=False, weekday_stats=None):
+    '''
+    Predicts the day after every cutoff in cv_cutoffs (except the last), like model_station
+    in notebook 06, but starts each fit from the parameters of the previous one, since
+    consecutive training sets differ by one day only. Every `refit_every` days (and on the
+    first day) the model is fitted from scratch instead.
+    With compare_cold=True, every warm fit is repeated cold to measure the drift.
+    The weekday statistics for y_dif_mean are built once from df_st, unless given.
+    Returns dict_m, ls_df as model_station does, and a dataframe with one row per day:
+    whether it was warm started, the fit time and, if compared, the cold yhat and the
+    relative difference to it.
+    '''
+    dict_m = {}
+    ls_df = []
+    rows_drift = []
+    init = None
+    if weekday_stats is None:
+        WeekdayStats = _dashboard_module('weekdaystats').WeekdayStats
+        weekday_stats = WeekdayStats.from_series(df_st.ds, df_st.y)
+    for i_day in range(len(cv_cutoffs) - 1):
+        ### day to predict traffic for and last day of training
+        day_pred = cv_cutoffs[i_day + 1]
+        cutoff_train = cv_cutoffs[i_day]
+
+        if refit_every and i_day % refit_every == 0:
+            init = None
+
+        start = time.perf_counter()
+        m, df_pred = model_station_day(params, df_st, cutoff_train, day_pred, rows_outp=rows_outp,
+                                       country_hol=country_hol, init=init, weekday_stats=weekday_stats)
+        row = {'day_predicted': day_pred, 'warm': init is not None,
+               'fit_seconds': time.perf_counter() - start, 'yhat': df_pred.yhat.iloc[-1]}
+
+        if compare_cold and init is not None:
+            _, df_cold = model_station_day(params, df_st, cutoff_train, day_pred, rows_outp=rows_outp,
+                                           country_hol=country_hol, weekday_stats=weekday_stats)
+            row['yhat_cold'] = df_cold.yhat.iloc[-1]
+            row['dif_cold'] = (row['yhat'] - row['yhat_cold']) / row['yhat_cold']
+
+        rows_drift.append(row)
+        ls_df.append(df_pred)
+        dict_m[day_pred] = m
+        init = warm_start_params(m)
+
+    return dict_m, ls_df, pd.DataFrame(rows_drift)
+
+
+#### Process pool
+
+### Daily series of every station with its WeekdayStats, set once per worker by _init_worker
+_SERIES = {}
+
+
+def _init_worker(series):
+    '''
+    Runs once in every worker: keeps the daily series, so tasks only carry the station
+    number, and silences Prophet and cmdstan for the whole life of the worker.
+    '''
+    global _SERIES
+    _SERIES = series
+    tm.suppress_in_worker()
+
+
+def _forecast_task(task):
+    '''
+    Fits and predicts one (station, cutoff) pair of the grid.
+    '''
+    zähl, params, cutoff_train, day_pred, country_hol, rows_outp = task
+    df_st, weekday_stats = _SERIES[zähl]
+    _, df_pred = model_station_day(params, df_st, cutoff_train, day_pred, rows_outp=rows_outp,
+                                   country_hol=country_hol, weekday_stats=weekday_stats)
+    ### Column for identifying the Zählstelle
+    df_pred["Zählstelle"] = zähl
+    return df_pred[PRED_COLUMNS]
+
+
+def _rolling_task(task):
+    '''
+    Runs the warm started rolling forecast of one station over all cutoffs.
+    '''
+    zähl, params, cv_cutoffs, country_hol, rows_outp, refit_every = task
+    df_st, weekday_stats = _SERIES[zähl]
+    _, ls_df, _ = rolling_forecast(params, df_st, cv_cutoffs, country_hol=country_hol, rows_outp=rows_outp,
+                                   refit_every=refit_every, weekday_stats=weekday_stats)
+    df_pred = pd.concat(ls_df, axis=0)
+    df_pred["Zählstelle"] = zähl
+    return df_pred[PRED_COLUMNS]
+
+
+def forecast_grid(df, df_params, cv_cutoffs, country_hol="DE", rows_outp=8, workers=None, stations=None,
+                  warm_start=False, refit_every=None):
+    '''
+    Predicts the day after every cutoff in cv_cutoffs (except the last) for every station of
+    df_params, or of `stations`, from the hourly dataframe df.
+    All (station, cutoff) fits run in a process pool with `workers` processes (default: one
+    per core); workers=1 runs them in this process. With warm_start=True, each station is one
+    task running "rolling_forecast" over its cutoffs instead. Returns {Zählstelle: df_pred},
+    with the predictions of every station in cutoff order, as stored in pred_station_date.pkl.
+    '''
+    if stations is None:
+        stations = list(df_params.Zählstelle)
+
+    WeekdayStats = _dashboard_module('weekdaystats').WeekdayStats
+    df_y, df_missing = daily_sums(df, stations)
+    series = {}
+    for zähl in stations:
+        df_st = daily_frame(df_y, df_missing, zähl)
+        series[zähl] = (df_st, WeekdayStats.from_series(df_st.ds, df_st.y))
+    if warm_start:
+        func = _rolling_task
+        tasks = [(zähl, get_params_zst(df_params, zähl), cv_cutoffs, country_hol, rows_outp, refit_every)
+                 for zähl in stations]
+    else:
+        func = _forecast_task
+        tasks = [(zähl, get_params_zst(df_params, zähl), cv_cutoffs[i_day], cv_cutoffs[i_day + 1],
+                  country_hol, rows_outp)
+                 for zähl in stations for i_day in range(len(cv_cutoffs) - 1)]
+
+    if workers == 1:
+        global _SERIES
+        _SERIES = series
+        results = [func(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(series,)) as pool:
+            ### pool.map keeps the order of the tasks
+            results = list(pool.map(func, tasks))
+
+    dict_df_zähl = {}
+    for zähl in stations:
+        ls_df = [df_pred for task, df_pred in zip(tasks, results) if task[0] == zähl]
+        dict_df_zähl[zähl] = pd.concat(ls_df, axis=0)
+
+    return dict_df_zähl
+
+
+### Function to fit one model per station and store it for the dashboard's prediction service
+def register_models(df, df_params, cutoff, registry_dir, country_hol="DE", stations=None):
+    '''
+    Fits the model of every station of df_params (or of `stations`) on the days of the
+    hourly dataframe df up to `cutoff`, with the hyperparameters of df_params, and saves it
+    in the ModelRegistry at registry_dir, where the dashboard loads it from when
+    MODEL_REGISTRY=<registry_dir> is set. Returns the registry.
+    '''
+    if stations is None:
+        stations = list(df_params.Zählstelle)
+
+    registry = _dashboard_module('predservice').ModelRegistry(registry_dir)
+    df_y, df_missing = daily_sums(df, stations)
+    for zähl in stations:
+        y_train, _ = time_split(daily_frame(df_y, df_missing, zähl), cutoff)
+        m = Prophet(**get_params_zst(df_params, zähl), daily_seasonality=False)
+        m.add_country_holidays(country_name=country_hol)
+        with tm.suppress_stdout_stderr():
+            m.fit(y_train)
+        registry.save(zähl, m)
+
+    return registry
@@ -1,8 +1,12 @@
 import os
+import sys
+import threading
+import warnings
 import pandas as pd
 import numpy as np
 
 # from https://stackoverflow.com/questions/11130156/suppress-stdout-stderr-print-from-python-functions
+# made re-entrant and leak-free for long batch runs
 
 class suppress_stdout_stderr(object):
     '''
@@ -13,25 +17,154 @@ class suppress_stdout_stderr(object):
     to stderr just before a script exits, and after the context manager has
     exited (at least, I think that is why it lets exceptions through).
 
+    The file descriptors 1 and 2 belong to the whole process, so the suppression does
+    too: it is re-entrant and shared by all threads. Only the outermost `with` redirects
+    (6 syscalls), nested ones only count, and the last one to exit restores the real
+    stdout/stderr and closes every descriptor that was opened.
+    With capture=n, the outermost one keeps the last n bytes of the suppressed output;
+    they are in .output after it exits (see also captured_output).
+    A process forked during a suppression (e.g. a pool worker) starts outside of it.
     '''
-    def __init__(self):
-        # Open a pair of null files
-        self.null_fds = [os.open(os.devnull, os.O_RDWR) for x in range(2)]
-        # Save the actual stdout (1) and stderr (2) file descriptors.
-        self.save_fds = (os.dup(1), os.dup(2))
+    _lock = threading.Lock()
+    _depth = 0
+    _saved_fds = None
+    _capture = None
+
+    def __init__(self, capture=0):
+        self.capture = capture
+        self.output = ''
 
     def __enter__(self):
-        # Assign the null pointers to stdout and stderr.
-        os.dup2(self.null_fds[0], 1)
-        os.dup2(self.null_fds[1], 2)
+        cls = suppress_stdout_stderr
+        with cls._lock:
+            if cls._depth > 0:
+                cls._depth += 1
+                return self
+            _flush_std()
+            opened, capture = [], None
+            try:
+                # Save the actual stdout (1) and stderr (2) file descriptors.
+                opened.append(os.dup(1))
+                opened.append(os.dup(2))
+                if self.capture:
+                    capture = _Capture(self.capture)
+                    target = capture.write_fd
+                else:
+                    target = os.open(os.devnull, os.O_WRONLY)
+                    opened.append(target)
+                # Point stdout and stderr to the null file (or the capture pipe), 1 and 2 keep it open
+                os.dup2(target, 1)
+                os.dup2(target, 2)
+            except OSError:
+                ### e.g. out of descriptors: put back what was redirected, close what was opened
+                ### and stay unsuppressed, so that the next `with` starts over
+                if len(opened) >= 2:
+                    os.dup2(opened[0], 1)
+                    os.dup2(opened[1], 2)
+                for fd in opened:
+                    os.close(fd)
+                if capture is not None:
+                    os.close(capture.write_fd)
+                    capture.close()
+                raise
+            os.close(target)
+            cls._saved_fds = (opened[0], opened[1])
+            cls._capture = capture
+            cls._depth = 1
+        return self
 
     def __exit__(self, *_):
-        # Re-assign the real stdout/stderr back to (1) and (2)
-        os.dup2(self.save_fds[0], 1)
-        os.dup2(self.save_fds[1], 2)
-        # Close the null files
-        os.close(self.null_fds[0])
-        os.close(self.null_fds[1])
+        cls = suppress_stdout_stderr
+        with cls._lock:
+            cls._depth -= 1
+            if cls._depth > 0:
+                return
+            _flush_std()
+            # Re-assign the real stdout/stderr back to (1) and (2) and close the saved copies
+            os.dup2(cls._saved_fds[0], 1)
+            os.dup2(cls._saved_fds[1], 2)
+            os.close(cls._saved_fds[0])
+            os.close(cls._saved_fds[1])
+            cls._saved_fds = None
+            if cls._capture is not None:
+                self.output = cls._capture.close()
+                cls._capture = None
+
+
+def _flush_std():
+    ### Python buffers its own output, write it out before the descriptors change
+    for stream in (sys.stdout, sys.stderr):
+        if stream is not None:
+            stream.flush()
+
+
+def _reinit_after_fork():
+    ### Another thread may have held the lock when the process forked
+    cls = suppress_stdout_stderr
+    cls._lock = threading.Lock()
+    ### A child forked during a suppression starts without one: the real stdout/stderr are
+    ### restored from the saved copies and the capture pipe, read by a thread of the parent, is closed
+    if cls._depth > 0:
+        os.dup2(cls._saved_fds[0], 1)
+        os.dup2(cls._saved_fds[1], 2)
+        os.close(cls._saved_fds[0])
+        os.close(cls._saved_fds[1])
+        if cls._capture is not None:
+            os.close(cls._capture.read_fd)
+    cls._depth, cls._saved_fds, cls._capture = 0, None, None
+
+
+os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class _Capture(object):
+    '''
+    A pipe whose read end is drained by a thread into a buffer of the last `limit` bytes.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.read_fd, self.write_fd = os.pipe()
+        self.thread = threading.Thread(target=self._read, name='suppress-capture', daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        while True:
+            chunk = os.read(self.read_fd, 65536)
+            if not chunk:
+                break
+            with self.lock:
+                self.buffer += chunk
+                del self.buffer[:-self.limit]
+        os.close(self.read_fd)
+
+    def tail(self):
+        with self.lock:
+            return self.buffer.decode(errors='replace')
+
+    def close(self):
+        # stdout/stderr were restored, so the pipe ends once processes started meanwhile
+        # (e.g. cmdstan) are done with it; don't wait long for ones still running
+        self.thread.join(timeout=1)
+        return self.tail()
+
+
+def suppress_in_worker(capture=0):
+    '''
+    Suppresses stdout and stderr for the rest of the life of the process, e.g. as (part of)
+    the initializer of a process pool. `with suppress_stdout_stderr()` in the tasks then
+    costs no syscalls.
+    '''
+    suppress_stdout_stderr(capture).__enter__()
+
+
+def captured_output():
+    '''
+    The output captured so far by the suppression in effect, if it was started with capture=n.
+    '''
+    capture = suppress_stdout_stderr._capture
+    return '' if capture is None else capture.tail()
 
 
 ### Build a pipeline
@@ -117,4 +250,281 @@ def cross_val_baseline(y,cutoffs,horizon):
     print('Mean MAPE is: ', df_metrics.MAPE.mean())
     print('Mean RMSE is: ', df_metrics.RMSE.mean())
 
-    return df,df_metrics
\ No newline at end of file
+    return df,df_metrics
+
+
+def copy_weekdays(values, positions, horizon):
+    '''Vectorised CopyRegressor: for every cutoff, given by the position of its first test day in the
+    daily values (shape (n_days,) or (n_days, n_stations)), returns the true values and the copied
+    predictions of the next horizon days, each of shape (n_cutoffs, horizon[, n_stations]).'''
+    weeksback = (horizon - 1) // 7 + 1
+    idx = np.asarray(positions)[:, None] + np.arange(horizon)[None, :]
+    if idx.min() - 7 * weeksback < 0 or idx.max() >= len(values):
+        raise ValueError('Not enough data before the first or after the last cutoff')
+    return values[idx], values[idx - 7 * weeksback]
+
+
+def cross_val_baseline_vec(y, cutoffs, horizon):
+    '''Same results as cross_val_baseline, computed for all cutoffs in one pass over a numpy array.
+    y may hold several stations in a "Zählstelle" column and horizon may be a list of horizons, then
+    df and df_metrics get a "Zählstelle" and a "horizon" column. Each station must be a gap free daily
+    series, as after InterpolateImputer.'''
+    stations = 'Zählstelle' in y.columns
+    horizons = list(horizon) if np.ndim(horizon) else [horizon]
+
+    # Days x stations matrix on a common daily index
+    if stations:
+        wide = y.pivot(index='ds', columns='Zählstelle', values='y')
+    else:
+        wide = y.set_index('ds')[['y']]
+    wide = wide.asfreq('D')
+    values = wide.to_numpy(dtype=float)
+
+    # Position of the first test day (the day after the cutoff) of every cutoff
+    cutoffs = pd.to_datetime(cutoffs)
+    positions = wide.index.searchsorted(cutoffs, side='right')
+
+    dfs = []
+    metrics = []
+    for h in horizons:
+        y_true, y_pred = copy_weekdays(values, positions, h)
+        # Same definitions as sklearn's mean_squared_error(squared=False) and mean_absolute_percentage_error
+        rmse = np.sqrt(np.nanmean((y_true - y_pred) ** 2, axis=1))
+        mape = np.nanmean(np.abs(y_true - y_pred) / np.maximum(np.abs(y_true), np.finfo(float).eps), axis=1)
+
+        ds = wide.index.to_numpy()[positions[:, None] + np.arange(h)[None, :]]
+        n_cut, n_st = len(cutoffs), values.shape[1]
+        df_h = pd.DataFrame({'ds': np.repeat(ds.ravel(), n_st), 'y': y_true.ravel(), 'yhat': y_pred.ravel()})
+        df_m = pd.DataFrame({'cutoff': np.repeat(cutoffs, n_st), 'RMSE': rmse.ravel(), 'MAPE': mape.ravel()})
+        if stations:
+            df_h.insert(0, 'Zählstelle', np.tile(wide.columns.to_numpy(), n_cut * h))
+            df_m.insert(0, 'Zählstelle', np.tile(wide.columns.to_numpy(), n_cut))
+        if len(horizons) > 1:
+            df_h['horizon'] = h
+            df_m['horizon'] = h
+        dfs.append(df_h.dropna(subset=['y']))
+        metrics.append(df_m)
+
+    df = pd.concat(dfs, ignore_index=True)
+    df_metrics = pd.concat(metrics, ignore_index=True)
+    if stations:
+        df = df.sort_values('Zählstelle', kind='stable', ignore_index=True)
+        df_metrics = df_metrics.sort_values('Zählstelle', kind='stable', ignore_index=True)
+    print('Mean MAPE is: ', df_metrics.MAPE.mean())
+    print('Mean RMSE is: ', df_metrics.RMSE.mean())
+
+    return df,df_metrics
+
+def copy_same_hours(values, positions, horizon, weeks=1):
+    '''Same-weekday-same-hour baseline for hourly values (shape (n_hours,) or (n_hours, n_stations)): for
+    every cutoff, given by the position of its first test hour, returns the true values and the predictions
+    of the next horizon hours, each of shape (n_cutoffs, horizon[, n_stations]). A prediction is the value of
+    the same hour one week before (as many weeks as needed to be known at the cutoff, like CopyRegressor),
+    or with weeks > 1 the mean over that many weeks. The windows are strided views of values, so nothing is
+    copied per cutoff except the results.'''
+    period = 7 * 24
+    weeksback = (horizon - 1) // period + 1
+    positions = np.asarray(positions)
+    if positions.min() - period * (weeksback + weeks - 1) < 0 or positions.max() + horizon > len(values):
+        raise ValueError('Not enough data before the first or after the last cutoff')
+
+    # windows[i] are the horizon hours starting at hour i
+    windows = np.moveaxis(np.lib.stride_tricks.sliding_window_view(values, horizon, axis=0), -1, 1)
+    y_true = windows[positions]
+    if weeks == 1:
+        return y_true, windows[positions - period * weeksback]
+    past = np.stack([windows[positions - period * (weeksback + k)] for k in range(weeks)])
+    with warnings.catch_warnings():
+        # Hours missing in every week stay NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return y_true, np.nanmean(past, axis=0)
+
+
+def cross_val_baseline_hourly(df_hours, cutoffs, horizon=24, weeks=1):
+    '''Hourly counterpart of cross_val_baseline_vec for all stations of an hour x station dataframe (see
+    hourly_values in trafficForecast): predicts the horizon hours after the end of every cutoff day with
+    copy_same_hours. Returns the predictions (Zählstelle, cutoff, ds, y, yhat, for the hours with a known y)
+    and RMSE and MAPE per station and cutoff.'''
+    values = df_hours.to_numpy()
+    if values.dtype.kind != 'f':
+        values = values.astype(float)
+    cutoffs = pd.to_datetime(cutoffs)
+    positions = df_hours.index.searchsorted(cutoffs.normalize() + pd.Timedelta(days=1))
+    y_true, y_pred = copy_same_hours(values, positions, horizon, weeks)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        err = (y_true - y_pred).astype(float)
+        rmse = np.sqrt(np.nanmean(err ** 2, axis=1))
+        mape = np.nanmean(np.abs(err) / np.maximum(np.abs(y_true), np.finfo(float).eps), axis=1)
+
+    n_cut, n_st = len(cutoffs), values.shape[1]
+    ds = df_hours.index.to_numpy()[positions[:, None] + np.arange(horizon)[None, :]]
+    # Station varies fastest, as in y_true.ravel()
+    df = pd.DataFrame({'Zählstelle': np.tile(df_hours.columns.to_numpy(), n_cut * horizon),
+                       'cutoff': np.repeat(cutoffs, horizon * n_st),
+                       'ds': np.repeat(ds.ravel(), n_st), 'y': y_true.ravel(), 'yhat': y_pred.ravel()})
+    df_metrics = pd.DataFrame({'Zählstelle': np.tile(df_hours.columns.to_numpy(), n_cut),
+                               'cutoff': np.repeat(cutoffs, n_st), 'RMSE': rmse.ravel(), 'MAPE': mape.ravel()})
+    df = df.dropna(subset=['y']).sort_values('Zählstelle', kind='stable', ignore_index=True)
+    df_metrics = df_metrics.sort_values('Zählstelle', kind='stable', ignore_index=True)
+    print('Mean MAPE is: ', df_metrics.MAPE.mean())
+    print('Mean RMSE is: ', df_metrics.RMSE.mean())
+
+    return df,df_metrics
+
+### Hyperparameter search
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from prophet import Prophet
+
+PARAM_COLUMNS = ['changepoint_prior_scale', 'seasonality_prior_scale', 'holidays_prior_scale', 'seasonality_mode']
+
+## Daily series of every station, set once per worker by _init_search_worker
+_SEARCH_SERIES = {}
+
+
+def data_hash(y):
+    '''Returns a short content hash of the ds and y columns of a daily series'''
+    values = pd.util.hash_pandas_object(y[['ds', 'y']], index=False).values
+    return hashlib.sha1(values.tobytes()).hexdigest()[:16]
+
+
+def cv_fold(y, params, cutoff, horizon, country_hol='DE'):
+    '''Fits Prophet with params on y up to and including cutoff and predicts the next horizon days,
+    like one fold of prophet's cross_validation. Returns ds, yhat, yhat_lower, yhat_upper, y and cutoff
+    of the days with known y.'''
+    cutoff = pd.Timestamp(cutoff)
+    y_train = y[y.ds <= cutoff]
+    y_test = y[(y.ds > cutoff) & (y.ds <= cutoff + pd.Timedelta(days=horizon))].dropna(subset=['y'])
+
+    m = Prophet(**params, daily_seasonality=False)
+    if country_hol:
+        m.add_country_holidays(country_name=country_hol)
+    with suppress_stdout_stderr():
+        m.fit(y_train)
+
+    df_cv = m.predict(y_test[['ds']])[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+    df_cv['y'] = y_test.y.values
+    df_cv['cutoff'] = cutoff
+    return df_cv
+
+
+def _fold_key(station, params, cutoff, horizon, country_hol, hash_):
+    key = json.dumps({'station': str(station), 'params': params, 'cutoff': str(pd.Timestamp(cutoff)),
+                      'horizon': horizon, 'country_hol': country_hol, 'data': hash_}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def fold_path(cache_dir, station, params, cutoff, horizon, country_hol, hash_):
+    '''Cache file of one cross-validation fold, named after everything the fold depends on,
+    including the hash of the data it uses (hash_).'''
+    return os.path.join(cache_dir, _fold_key(station, params, cutoff, horizon, country_hol, hash_) + '.pkl')
+
+
+def run_folds(series, tasks, workers=None):
+    '''Computes the cross-validation folds (station, params, cutoff, horizon, country_hol, path) of
+    tasks on the daily series of the stations ({Zählstelle: dataframe with ds and y}) and writes
+    each to its path (see fold_path). Runs in a process pool with `workers` processes, workers=1
+    runs them in this process.'''
+    if workers == 1:
+        global _SEARCH_SERIES
+        _SEARCH_SERIES = series
+        for task in tasks:
+            _search_task(task)
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_search_worker,
+                                 initargs=(series,)) as pool:
+            list(pool.map(_search_task, tasks))
+
+
+def _init_search_worker(series):
+    global _SEARCH_SERIES
+    _SEARCH_SERIES = series
+    suppress_in_worker()
+
+
+def _search_task(task):
+    '''Runs one cached fold and writes it to the cache. Returns the cache path.'''
+    station, params, cutoff, horizon, country_hol, path = task
+    df_cv = cv_fold(_SEARCH_SERIES[station], params, cutoff, horizon, country_hol)
+    # Write next to the final name first, an interrupted write leaves no broken cache entry
+    df_cv.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def search_hyperparameters(series, all_params, cutoffs, horizon, cache_dir, country_hol='DE',
+                           workers=None, eta=3, min_cutoffs=1, outfile=None):
+    '''
+    Grid search of Prophet hyperparameters for every station, replacing do_multi_experiments of notebook 05.
+
+    series: {Zählstelle: daily dataframe with ds and y}, all_params: list of parameter dicts.
+    Every (station, params, cutoff) fold is cached in cache_dir under a key that includes a hash of the
+    station's data, so repeated or interrupted searches only compute missing folds. Folds run in a process
+    pool with `workers` processes (workers=1 runs them in this process).
+    Successive halving: all combinations are first scored on the first `min_cutoffs` cutoffs, then only the
+    best 1/eta are scored on eta times as many cutoffs, until all cutoffs are used. eta=None scores every
+    combination on all cutoffs.
+    Returns the best parameters per station (written to outfile as csv if given, in the layout of
+    hyperparameter_search_complete.csv) and the scores of every evaluated combination and round.
+    '''
+    # Otherwise n_cut never grows to all cutoffs and the rounds never end
+    if eta is not None and eta < 2:
+        raise ValueError(f'eta must be at least 2 or None, got {eta}')
+    if min_cutoffs < 1:
+        raise ValueError(f'min_cutoffs must be at least 1, got {min_cutoffs}')
+    os.makedirs(cache_dir, exist_ok=True)
+    cutoffs = list(pd.to_datetime(cutoffs))
+    hashes = {station: data_hash(y) for station, y in series.items()}
+    candidates = {station: list(range(len(all_params))) for station in series}
+    n_cut = len(cutoffs) if not eta else min(min_cutoffs, len(cutoffs))
+
+    scores = []
+    round_ = 0
+    while True:
+        # Folds of this round, and those not in the cache yet
+        folds = {}
+        for station in series:
+            for i in candidates[station]:
+                for cutoff in cutoffs[:n_cut]:
+                    folds[(station, i, cutoff)] = fold_path(cache_dir, station, all_params[i], cutoff, horizon,
+                                                            country_hol, hashes[station])
+        tasks = [(station, all_params[i], cutoff, horizon, country_hol, path)
+                 for (station, i, cutoff), path in folds.items() if not os.path.exists(path)]
+        print(f'Round {round_}: {len(folds)} folds on {n_cut} cutoffs, {len(tasks)} not cached')
+
+        run_folds(series, tasks, workers)
+
+        # Score every candidate on the folds of this round, like do_multi_experiments
+        for station in series:
+            for i in candidates[station]:
+                df_cv = pd.concat([pd.read_pickle(folds[(station, i, cutoff)]) for cutoff in cutoffs[:n_cut]])
+                scores.append({'Zählstelle': station, 'experiment': i, 'round': round_, 'n_cutoffs': n_cut,
+                               **all_params[i],
+                               'MAPE': mean_absolute_percentage_error(df_cv.y, df_cv.yhat.round()),
+                               'RMSE': mean_squared_error(df_cv.y, df_cv.yhat, squared=False)})
+
+        if n_cut >= len(cutoffs):
+            break
+
+        # Keep the best 1/eta of the candidates of every station for the next round
+        df_round = pd.DataFrame([s for s in scores if s['round'] == round_])
+        for station in series:
+            ranked = df_round[df_round['Zählstelle'] == station].sort_values('MAPE').experiment
+            candidates[station] = list(ranked[:max(1, int(np.ceil(len(ranked) / eta)))])
+        n_cut = min(len(cutoffs), n_cut * eta)
+        round_ += 1
+
+    df_scores = pd.DataFrame(scores)
+    df_best = (df_scores[df_scores['round'] == round_].sort_values('MAPE')
+               .groupby('Zählstelle', sort=False).head(1).sort_values('Zählstelle'))
+    df_best = df_best[['Zählstelle'] + PARAM_COLUMNS + ['MAPE', 'RMSE']].reset_index(drop=True)
+    df_best['Include'] = 1
+    df_best['Comments'] = ''
+
+    if outfile is not None:
+        df_best.to_csv(outfile, index=False)
+
+    return df_best, df_scores
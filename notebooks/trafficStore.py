@@ -0,0 +1,214 @@
+'''
+Columnar storage of the compiled Zählstelle data.
+
+The hourly counts are written as a parquet dataset partitioned by station and year,
+i.e. <root>/Zählstelle=<number>/year=<year>/<source>-<i>.parquet, so a reader that
+asks for some stations and dates only opens the files of those partitions.
+
+All loaders return the compact schema of SCHEMA (see enforce_schema): int16 station
+numbers, nullable uint16 counts and a datetime64 index, 19 bytes per hourly row (8 for the
+index, 2 for the station and 2 plus a 1 byte mask per count) instead of the python strings
+of the original parser.
+
+A manifest (<root>/_manifest.json) records every ingested source file with its size,
+mtime, sha1 and the first and last timestamp of every station in it, so later runs
+only have to parse new or changed files and upsert them.
+'''
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+
+PARTITIONS = ['Zählstelle', 'year']
+MANIFEST = '_manifest.json'
+
+### Compact schema of the hourly counts: station numbers fit int16, hourly counts uint16
+### (<NA> where a count is missing), the index is datetime64[ns] named 'datetime'
+SCHEMA = {'Zählstelle': 'int16', 'PKW': 'UInt16', 'LKW': 'UInt16', 'Gesamt': 'UInt16'}
+
+
+def enforce_schema(df):
+    '''
+    Returns the hourly dataframe df (datetime index, columns Zählstelle, PKW, LKW, Gesamt
+    as numbers or strings) in the compact schema of SCHEMA. Malformed counts become <NA>.
+    Raises ValueError if a value does not fit its type or a station number is missing.
+    '''
+    out = pd.DataFrame(index=pd.DatetimeIndex(df.index, name='datetime').astype('datetime64[ns]'))
+    for col, dtype in SCHEMA.items():
+        values = df[col]
+        if not pd.api.types.is_numeric_dtype(values.dtype):
+            values = pd.to_numeric(np.asarray(values, dtype=object), errors='coerce')
+        values = pd.array(values)
+        missing = pd.isna(values)
+        if col == 'Zählstelle' and missing.any():
+            raise ValueError('Rows without a station number')
+        bounds = np.iinfo(dtype.lower())
+        known = values[~missing]
+        if len(known) and (known.min() < bounds.min or known.max() > bounds.max):
+            raise ValueError(f'{col} has values outside the range of {dtype}: {known.min()} to {known.max()}')
+        out[col] = values.astype(dtype)
+    return out
+
+
+def memory_report(usage, rows):
+    '''
+    Returns a text report of the memory used by `rows` hourly rows, from the bytes per
+    column as given by df.memory_usage(deep=True) (possibly summed over several frames).
+    '''
+    total = usage.sum()
+    lines = [f'{rows} rows in {total / 1e6:.1f} MB, {total / max(rows, 1):.1f} bytes per row']
+    for col, nbytes in usage.items():
+        dtype = 'datetime64[ns]' if col == 'Index' else SCHEMA.get(col, '')
+        lines.append(f'  {col:<12} {dtype:<16} {nbytes / 1e6:8.1f} MB')
+    return '\n'.join(lines)
+
+
+def read_compiled_csv(path):
+    '''
+    Reads the compiled csv of csv-wrangling.py in the compact schema.
+    '''
+    df = pd.read_csv(path, index_col='datetime', parse_dates=['datetime'],
+                     dtype={'Zählstelle': 'int64', 'PKW': 'Int64', 'LKW': 'Int64', 'Gesamt': 'Int64'})
+    return enforce_schema(df)
+
+
+def write_partitioned(df, root, name='part'):
+    '''
+    Writes an hourly dataframe (datetime index, columns Zählstelle, PKW, LKW, Gesamt)
+    into the dataset at root. Files are named after `name`, e.g. the source csv, so
+    writing the same source again replaces its files instead of duplicating rows.
+    '''
+    df = df.reset_index()
+    df['Zählstelle'] = df['Zählstelle'].astype(str)
+    df['year'] = df['datetime'].dt.year
+    df.to_parquet(root, partition_cols=PARTITIONS, index=False,
+                  basename_template=f'{name}-{{i}}.parquet')
+
+
+def upsert_partitioned(df, root, replace=None):
+    '''
+    Merges an hourly dataframe into the dataset at root. Rows with the same station and
+    datetime as stored rows replace them. Only the touched partitions are read and each
+    is rewritten as a single file.
+    replace, {station: [first, last]} as in the manifest, deletes the stored rows of those
+    stations between first and last (inclusive) before merging, e.g. the rows of the
+    previous version of a changed source file, so rows it no longer has do not stay.
+    Source files are expected not to overlap, rows of other files in these ranges are
+    deleted as well.
+    '''
+    df = df.reset_index()
+    df['Zählstelle'] = df['Zählstelle'].astype(str)
+    df['year'] = df['datetime'].dt.year
+    groups = {key: new for key, new in df.groupby(PARTITIONS, observed=True)}
+
+    ### The partitions of the deleted ranges are touched too, even if df has no rows there
+    replace = {str(station): (pd.Timestamp(first), pd.Timestamp(last))
+               for station, (first, last) in (replace or {}).items()}
+    partitions = set(groups)
+    for station, (first, last) in replace.items():
+        partitions.update((station, year) for year in range(first.year, last.year + 1)
+                          if os.path.isdir(os.path.join(root, f'Zählstelle={station}', f'year={year}')))
+
+    for station, year in sorted(partitions):
+        path = os.path.join(root, f'Zählstelle={station}', f'year={year}')
+        new = groups.get((station, year), df.iloc[:0]).drop(columns=PARTITIONS)
+        old_files = sorted(glob.glob(os.path.join(path, '*.parquet')))
+        if old_files:
+            old = pd.concat([pd.read_parquet(f) for f in old_files])
+            if station in replace:
+                first, last = replace[station]
+                old = old[(old['datetime'] < first) | (old['datetime'] > last)]
+            new = pd.concat([old, new]).drop_duplicates('datetime', keep='last')
+        new = new.sort_values('datetime')
+
+        if new.empty:
+            for f in old_files:
+                os.remove(f)
+            continue
+
+        ### Write next to the old files first, so a failed write leaves them intact
+        os.makedirs(path, exist_ok=True)
+        tmp = os.path.join(path, '_upsert.tmp')
+        new.to_parquet(tmp, index=False)
+        for f in old_files:
+            os.remove(f)
+        os.replace(tmp, os.path.join(path, 'part-0.parquet'))
+
+
+def station_ranges(df):
+    '''
+    Returns {station: [first, last]} timestamps of an hourly dataframe, as stored in the manifest.
+    '''
+    ranges = df.index.to_series().groupby(df['Zählstelle'].astype(str).to_numpy()).agg(['min', 'max'])
+    return {station: [str(first), str(last)] for station, (first, last) in ranges.iterrows()}
+
+
+def read_manifest(root):
+    '''
+    Returns the manifest of the dataset at root, {source file name: entry}, or an empty
+    dict if nothing was ingested yet.
+    '''
+    path = os.path.join(root, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(root, manifest):
+    '''
+    Replaces the manifest of the dataset at root in one step, so it never refers to
+    half-written data.
+    '''
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def ingested_ranges(root):
+    '''
+    Returns a dataframe with the first and last ingested timestamp of every station,
+    taken from the manifest without reading any data.
+    '''
+    rows = [(int(station), pd.Timestamp(first), pd.Timestamp(last))
+            for entry in read_manifest(root).values()
+            for station, (first, last) in entry['stations'].items()]
+    df = pd.DataFrame(rows, columns=['Zählstelle', 'first', 'last'])
+    return df.groupby('Zählstelle').agg({'first': 'min', 'last': 'max'})
+
+
+def read_partitioned(root, stations=None, start=None, end=None, columns=None):
+    '''
+    Reads hourly counts from the dataset at root into a dataframe with a datetime index,
+    sorted by station and time, like the compiled csv, in the compact schema (only the
+    requested columns).
+    Only the partitions of the requested stations and of the years between start and end
+    (both inclusive days) are read.
+    '''
+    filters = []
+    if stations is not None:
+        filters.append(('Zählstelle', 'in', [int(s) for s in stations]))
+    if start is not None:
+        start = pd.Timestamp(start).normalize()
+        filters += [('year', '>=', start.year), ('datetime', '>=', start)]
+    if end is not None:
+        end = pd.Timestamp(end).normalize()
+        filters += [('year', '<=', end.year), ('datetime', '<', end + pd.Timedelta(days=1))]
+    if columns is not None:
+        columns = ['datetime', 'Zählstelle'] + [c for c in columns if c not in ('datetime', 'Zählstelle')]
+
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f'No dataset found at {root}')
+
+    df = pd.read_parquet(root, filters=filters or None, columns=columns)
+    ### Partition columns come last, move the station back to the front
+    df = df[['datetime', 'Zählstelle'] + [c for c in df.columns if c not in ('datetime', 'Zählstelle', 'year')]]
+    df['Zählstelle'] = df['Zählstelle'].astype(SCHEMA['Zählstelle'])
+    df = df.sort_values(['Zählstelle', 'datetime'], kind='stable').set_index('datetime')
+    ### Datasets written before the compact schema have wider counts
+    df = df.astype({col: SCHEMA[col] for col in df.columns})
+
+    return df